@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+
+#
+# Benchmarks for the timelapse pipeline, run against synthetic source
+# sequences
+#
+# Usage:
+#
+#   ./benchmark.py SUITE [--size 1920x1080] [--count 10] [--format jpg]
+#                        [--frames 50] [--repeat 3] [--json results.json]
+#   ./benchmark.py compare baseline.json results.json [--threshold 0.1]
+#
+# SUITE is one of geometry, stages, render, lite, stack or all.
+#
+
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy
+import PIL
+from PIL import Image
+
+from interpimage import *
+from sinks import ImageSequenceSink
+
+SUITES = ("geometry", "stages", "render", "lite", "stack")
+
+
+def parseSize(s):
+    "Parse a WIDTHxHEIGHT string"
+    w, h = s.lower().split("x")
+    return (int(w), int(h))
+
+
+def syntheticImage(size, fname, seed=0):
+    """Write a photo-like test image of SIZE to FNAME: smooth gradients with
+       some fine detail and noise, so codecs and resamplers do real work
+
+    """
+    w, h = size
+    rng = numpy.random.default_rng(seed)
+    y, x = numpy.mgrid[0:h, 0:w].astype(numpy.float32)
+    phase = rng.random(3) * 6.0
+    img = numpy.stack([
+        128 + 90 * numpy.sin(x / (w / 7.0) + phase[0]),
+        128 + 90 * numpy.cos(y / (h / 5.0) + phase[1]),
+        128 + 60 * numpy.sin((x + y) / 23.0 + phase[2]),
+    ], axis=-1)
+    img += rng.normal(0, 6, img.shape).astype(numpy.float32)
+    Image.fromarray(numpy.clip(img, 0, 255).astype(numpy.uint8)).save(fname)
+    return fname
+
+
+def syntheticSequence(dirname, count, size, fmt="jpg", interval=60):
+    """Write COUNT synthetic images into DIRNAME, with modification times
+       INTERVAL seconds apart; returns their filenames in time order
+
+    """
+    start = time.time() - count * interval
+    fnames = []
+    for i in range(count):
+        fname = syntheticImage(size, os.path.join(dirname, "src-%04d.%s" %
+                                                  (i, fmt)), seed=i)
+        os.utime(fname, (start + i * interval, start + i * interval))
+        fnames.append(fname)
+    return fnames
+
+
+def timeIt(fn, repeat=3, setup=None):
+    """Return the best wall-clock time of REPEAT calls of FN, passed the
+       result of SETUP (untimed) if given; output is discarded
+
+    """
+    best = None
+    for i in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            arg = setup() if setup is not None else None
+            start = time.time()
+            fn(arg) if setup is not None else fn()
+            elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def record(results, name, seconds, units=None):
+    "Note SECONDS for benchmark NAME, printing it with an optional rate"
+    results[name] = seconds
+    rate = ""
+    if units:
+        rate = "  %8.2f/sec" % (units / max(seconds, 1e-9))
+    print("%-44s %9.4fs%s" % (name, seconds, rate))
+
+
+def benchGeometry(args, tmpdir, results):
+    """Time loading one source with stepwise and fused geometry, for several
+       rotate/crop/scale settings
+
+    """
+    w, h = args.size or (6000, 4000)
+    cases = [
+        ("crop+scale", None, [[w // 10, h // 10], [w * 9 // 10, h * 9 // 10]],
+         [1920, 1080]),
+        ("rotate+crop+scale", 2.5,
+         [[w // 8, h // 8], [w * 7 // 8, h * 7 // 8]], [1920, 1080]),
+        ("rotate", 2.5, None, None),
+        ("preview rotate+crop+scale", 2.5,
+         [[w // 8, h // 8], [w * 7 // 8, h * 7 // 8]], [1920, 1080]),
+    ]
+    fname = syntheticImage((w, h), os.path.join(tmpdir, "geometry." +
+                                                args.format))
+    for (name, rot, crop, scale) in cases:
+        preview = 4 if name.startswith("preview") else 1
+        for fused in (False, True):
+            src = InterpImage(fname, crop=crop, scale=scale, rotate=rot,
+                              preview=preview, fused=fused)
+            record(results, "geometry.%s.%s" %
+                   (name.replace(" ", "-"), "fused" if fused else "stepwise"),
+                   timeIt(src.loadImage, args.repeat))
+
+
+def benchStages(args, tmpdir, results):
+    "Time each per-frame operation on a pair of synthetic sources"
+    size = args.size or (1920, 1080)
+    f1, f2 = syntheticSequence(tmpdir, 2, size, args.format)
+    a = InterpImage(f1)
+    b = InterpImage(f2)
+    img = a.image
+    mask = Image.open(syntheticImage(size, os.path.join(tmpdir, "mask.png"),
+                                     seed=99)).convert("RGB")
+    record(results, "stages.loadImage",
+           timeIt(lambda: InterpImage(f1).loadImage(), args.repeat))
+    record(results, "stages.imageCtime",
+           timeIt(lambda: InterpImage(f1).imageCtime(), args.repeat))
+    record(results, "stages.interp", timeIt(lambda: a.interp(b, 0.3),
+                                            args.repeat))
+    record(results, "stages.imageAutoContrast",
+           timeIt(lambda: imageAutoContrast(img, 0.5), args.repeat))
+    record(results, "stages.imageMask", timeIt(lambda: imageMask(img, mask),
+                                               args.repeat))
+    record(results, "stages.imageGamma",
+           timeIt(lambda: imageGamma(img, (1.1, 0.9, 1.2)), args.repeat))
+    record(results, "stages.imageBlur", timeIt(lambda: imageBlur(img, 3.5),
+                                               args.repeat))
+    record(results, "stages.imageBlur-stepwise",
+           timeIt(lambda: imageBlur(img, 3.5, False), args.repeat))
+    for fmt in ("png", "jpg"):
+        record(results, "stages.save-" + fmt,
+               timeIt(lambda: img.save(os.path.join(tmpdir, "out." + fmt)),
+                      args.repeat))
+
+
+def writeConfig(fname, sources, outdir, frames, effects=False, **settings):
+    """Write a Timeline configuration rendering SOURCES to FRAMES frames,
+       with gamma, blur and auto-contrast keyframed on alternate sources if
+       EFFECTS
+
+    """
+    filelist = [{"name": f} for f in sources]
+    if effects:
+        for entry in filelist[1::2]:
+            entry.update({"gamma": [1.1, 1.0, 0.9], "blur": 1.5, "ac": 0.5})
+    config = {
+        "filelist": filelist,
+        "inpattern": None,
+        "outdir": outdir,
+        "outformat": "jpg",
+        "noframes": frames,
+        "incremental": False,
+    }
+    config.update(settings)
+    open(fname, "w").write(json.dumps(config, indent=1))
+    return fname
+
+
+def benchRender(args, tmpdir, results):
+    "Time full Timeline renders with each renderer and pixel engine"
+    from timeline import Timeline
+    sources = syntheticSequence(tmpdir, args.count, args.size or (1920, 1080),
+                                args.format)
+    outdir = os.path.join(tmpdir, "out")
+    os.makedirs(outdir)
+    cases = [
+        ("linear-pil", {"renderer": "linear"}),
+        ("linear-pil-effects", {"renderer": "linear", "effects": True}),
+        ("threads-pil", {"renderer": "threads"}),
+        ("linear-numpy", {"renderer": "linear", "engine": "numpy"}),
+        ("linear-numpy-effects", {"renderer": "linear", "engine": "numpy",
+                                  "effects": True}),
+        ("processes-numpy", {"renderer": "processes", "engine": "numpy"}),
+    ]
+    for (name, settings) in cases:
+        conf = writeConfig(os.path.join(tmpdir, name + ".json"), sources,
+                           outdir, args.frames, **settings)
+        record(results, "render." + name,
+               timeIt(lambda tl: tl.render(), args.repeat,
+                      lambda: Timeline(conf)), args.frames)
+
+
+def benchLite(args, tmpdir, results):
+    "Time timelapse-lite.py's pipeline over a synthetic sequence"
+    lite = importlib.import_module("timelapse-lite")
+    indir = os.path.join(tmpdir, "in")
+    outdir = os.path.join(tmpdir, "out")
+    os.makedirs(indir)
+    os.makedirs(outdir)
+    syntheticSequence(indir, args.count, args.size or (1920, 1080),
+                      args.format)
+    filedata = lite.findFiles(indir)
+    for workers in ((1, 1, 1), (2, 2, 2), (1, 4, 4)):
+        record(results, "lite.%d-%d-%d" % workers,
+               timeIt(lambda: lite.interpolateImages(
+                   lite.itertasks(filedata, args.frames),
+                   ImageSequenceSink(outdir + "/img-%05d.jpg"), workers),
+                   args.repeat), args.frames)
+
+
+def benchStack(args, tmpdir, results):
+    "Time stacking a synthetic sequence in each mode"
+    import stacker
+    sources = syntheticSequence(tmpdir, args.count, args.size or (1920, 1080),
+                                args.format)
+    for mode in ("mean", "max", "weighted"):
+        record(results, "stack." + mode,
+               timeIt(lambda: stacker.stackFiles(sources, mode).result(),
+                      args.repeat), len(sources))
+    for mode in stacker.TILED_MODES:
+        record(results, "stack." + mode,
+               timeIt(lambda: stacker.stackTiled(sources, mode,
+                                                 tmpdir=tmpdir),
+                      args.repeat), len(sources))
+    record(results, "stack.write-png16",
+           timeIt(lambda: stacker.writeImage(
+               os.path.join(tmpdir, "out.png"),
+               numpy.zeros((1080, 1920, 3)), 16), args.repeat))
+
+
+BENCHMARKS = {
+    "geometry": benchGeometry,
+    "stages": benchStages,
+    "render": benchRender,
+    "lite": benchLite,
+    "stack": benchStack,
+}
+
+
+def runSuites(args):
+    "Run the requested suites, each in its own scratch directory"
+    results = {}
+    for suite in (SUITES if args.suite == "all" else (args.suite,)):
+        tmpdir = tempfile.mkdtemp(prefix="benchmark-")
+        try:
+            BENCHMARKS[suite](args, tmpdir, results)
+        finally:
+            shutil.rmtree(tmpdir)
+    return {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "host": platform.node(),
+            "cpus": os.cpu_count(),
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "numpy": numpy.__version__,
+            "size": args.size,
+            "count": args.count,
+            "format": args.format,
+            "frames": args.frames,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+
+
+def compare(base, new, threshold=0.1):
+    """Print each benchmark in both result files BASE and NEW with its change
+       in time, flagging those slower by more than THRESHOLD; returns the
+       number of regressions
+
+    """
+    old = json.loads(open(base, "r").read())["results"]
+    cur = json.loads(open(new, "r").read())["results"]
+    regressions = 0
+    for name in sorted(set(old) & set(cur)):
+        ratio = cur[name] / max(old[name], 1e-9)
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "REGRESSION"
+            regressions += 1
+        elif ratio < 1 - threshold:
+            flag = "improved"
+        print("%-44s %9.4fs -> %9.4fs %+7.1f%%  %s" %
+              (name, old[name], cur[name], (ratio - 1) * 100, flag))
+    for name in sorted(set(old) ^ set(cur)):
+        print("%-44s only in %s" % (name, base if name in old else new))
+    print("%d regressions beyond %.0f%%" % (regressions, threshold * 100))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Timelapse benchmarks")
+    parser.add_argument("suite", choices=SUITES + ("all", "compare"))
+    parser.add_argument("files", nargs="*",
+                        help="for compare: baseline and new JSON results")
+    parser.add_argument("--size", type=parseSize,
+                        help="synthetic source size, WIDTHxHEIGHT (default "
+                        "6000x4000 for geometry, else 1920x1080)")
+    parser.add_argument("--count", type=int, default=10,
+                        help="number of synthetic sources")
+    parser.add_argument("--format", default="jpg",
+                        help="synthetic source format (file extension)")
+    parser.add_argument("--frames", type=int, default=50,
+                        help="frames to render")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="take the best of this many runs")
+    parser.add_argument("--json", metavar="FILE",
+                        help="write the results to FILE as JSON")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="for compare: fractional slowdown to flag")
+    args = parser.parse_args()
+
+    if args.suite == "compare":
+        if len(args.files) != 2:
+            parser.error("compare needs a baseline and a new results file")
+        sys.exit(1 if compare(args.files[0], args.files[1],
+                              args.threshold) else 0)
+    if args.files:
+        parser.error("unexpected arguments: %s" % " ".join(args.files))
+    report = runSuites(args)
+    if args.json:
+        open(args.json, "w").write(json.dumps(report, indent=1,
+                                              sort_keys=True))
+        print("Written %s" % args.json)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+#
+# Memory budget for rendering: estimates of the bytes taken by each frame in
+# flight and each decoded source, from which the number of workers and the
+# source cache size are chosen, and a governor narrowing the frames in flight
+# when the memory actually in use nears the budget
+#
+
+import multiprocessing
+import os
+import threading
+
+from tracing import currentRSS
+
+# Share of physical memory taken by a budget of "auto"
+AUTO_FRACTION = 0.75
+
+# Sources that must stay decoded: the pair being blended, and the next
+# being prefetched
+WINDOW_SOURCES = 4
+
+# Shares of the budget above which the governor throttles, and below which it
+# lets another frame into flight
+HIGH_WATER = 0.9
+LOW_WATER = 0.7
+
+# Resident bytes of a worker process before it renders anything: an
+# interpreter with NumPy and PIL loaded
+WORKER_BYTES = 64 * 1024 * 1024
+
+MB = 1048576.0
+
+
+def parseBytes(s):
+    "Parse a byte count with an optional K, M or G suffix"
+    s = str(s).strip().upper().rstrip("B")
+    for (suffix, scale) in (("K", 1 << 10), ("M", 1 << 20), ("G", 1 << 30)):
+        if s.endswith(suffix):
+            return int(float(s[:-1]) * scale)
+    return int(s)
+
+
+def physicalMemory():
+    "Return the bytes of physical memory, or None if unknown"
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def parseBudget(spec):
+    """Return the memory budget in bytes given by SPEC: a byte count with an
+       optional K, M or G suffix, "auto" for most of physical memory, or None
+       for no budget
+
+    """
+    if spec is None:
+        return None
+    if str(spec).lower() == "auto":
+        total = physicalMemory()
+        return None if total is None else int(total * AUTO_FRACTION)
+    return parseBytes(spec)
+
+
+def frameWorkingSet(tl):
+    """Return an estimate of the peak bytes taken by one frame of timeline TL
+       while it is rendered, from its size and the effects in use
+
+    """
+    (w, h) = tl.filelist[0].frameSize()
+    rgb = w * h * 3
+    if tl.engine == "numpy":
+        # float32 accumulator and the result
+        return rgb * 4 + rgb
+    # the blend and its tone-mapped copy, then a copy per effect
+    n = 2 * rgb
+    if any(m is not None for (t, m) in tl.masks):
+        n += rgb + w * h
+    if any(v != 0 for (t, v) in tl.ac) or tl.usesLevels():
+        n += rgb
+    if any(v != 0 for (t, v) in tl.blur):
+        n += rgb if tl.fastblur else 2 * rgb
+    return n
+
+
+def sourceBytes(tl):
+    "Return the bytes taken by one decoded source of timeline TL in the cache"
+    (w, h) = tl.filelist[0].frameSize()
+    return w * h * 3
+
+
+def decodeBytes(tl):
+    """Return the bytes taken while decoding one source of timeline TL, before
+       it is cropped and scaled
+
+    """
+    (w, h) = tl.filelist[0].sourceSize()
+    n = w * h * 3 // tl.preview ** 2
+    return n if tl.fusedgeometry else 2 * n
+
+
+def encodeBytes(tl):
+    "Return the bytes of finished frames that may wait for the encoders"
+    return 3 * max(tl.encoders, 1) * sourceBytes(tl)
+
+
+def planThreads(tl, budget, limit, cachebytes, base=None):
+    """Return (threads, cachebytes): how many of at most LIMIT frames timeline
+       TL can render at once in one process, and how much of at most
+       CACHEBYTES to cache sources in, staying within BUDGET bytes with BASE
+       (by default what this process has now) already in use
+
+    """
+    if base is None:
+        base = currentRSS()
+    frame = frameWorkingSet(tl)
+    free = budget - base - decodeBytes(tl) - encodeBytes(tl)
+    mincache = WINDOW_SOURCES * sourceBytes(tl)
+    cache = min(cachebytes, max(mincache, free // 3))
+    threads = int(max(1, min(limit, (free - cache) // frame)))
+    print("Memory budget %.0fMB: %.0fMB in use, %.1fMB per frame, "
+          "%.1fMB per source; %d threads, %.0fMB source cache" %
+          (budget / MB, base / MB, frame / MB, sourceBytes(tl) / MB, threads,
+           cache / MB))
+    if free - cache < frame:
+        print("Memory budget is too small for even one frame at a time")
+    return (threads, cache)
+
+
+def planProcesses(tl, budget, limit, cachebytes, base=None):
+    """Return (processes, cachebytes): how many of at most LIMIT worker
+       processes, each rendering a frame at a time with its own source cache
+       of at most CACHEBYTES, fit in BUDGET bytes along with this process,
+       which has BASE bytes (by default what it has now) in use
+
+    """
+    if base is None:
+        base = currentRSS()
+    fixed = (WORKER_BYTES + decodeBytes(tl) + encodeBytes(tl) +
+             frameWorkingSet(tl))
+    mincache = WINDOW_SOURCES * sourceBytes(tl)
+    for procs in range(int(limit), 0, -1):
+        share = (budget - base) // procs
+        if share >= fixed + mincache:
+            break
+    cache = int(min(cachebytes, max(mincache, share - fixed)))
+    print("Memory budget %.0fMB: %.0fMB in use, %.0fMB per process before "
+          "caching, %.1fMB per frame; %d processes, %.0fMB source cache each" %
+          (budget / MB, base / MB, fixed / MB, frameWorkingSet(tl) / MB,
+           procs, cache / MB))
+    if share < fixed + mincache:
+        print("Memory budget is too small for even one worker process")
+    return (procs, cache)
+
+
+def processTreeRSS():
+    "Return the resident bytes of this process and its children"
+    return currentRSS() + sum(currentRSS(p.pid)
+                              for p in multiprocessing.active_children())
+
+
+class Governor(object):
+    """Allows at most LIMIT frames in flight, fewer while the memory given by
+       MEASURE nears BUDGET bytes, shrinking CACHE no lower than MINCACHE as
+       well; a limit cut is relaxed a frame at a time as memory is freed"""
+
+    def __init__(self, budget, limit, cache=None, mincache=0,
+                 measure=currentRSS):
+        self.budget = budget
+        self.limit = limit
+        self.allowed = limit
+        self.cache = cache
+        self.mincache = mincache
+        self.measure = measure
+        self.throttles = 0
+        self.lock = threading.Lock()
+
+    def workers(self):
+        "Return how many frames may be in flight now"
+        rss = self.measure()
+        with self.lock:
+            if rss > HIGH_WATER * self.budget:
+                if self.cache is not None and (self.cache.maxbytes >
+                                               self.mincache):
+                    self.cache.resize(max(self.mincache,
+                                          self.cache.maxbytes * 3 // 4))
+                    print("Memory at %.0fMB of %.0fMB: source cache cut to "
+                          "%.0fMB" % (rss / MB, self.budget / MB,
+                                      self.cache.maxbytes / MB))
+                if self.allowed > 1:
+                    self.allowed = max(1, self.allowed // 2)
+                    self.throttles += 1
+                    print("Memory at %.0fMB of %.0fMB: throttled to %d "
+                          "frames in flight" % (rss / MB, self.budget / MB,
+                                                self.allowed))
+            elif rss < LOW_WATER * self.budget and self.allowed < self.limit:
+                self.allowed += 1
+            return self.allowed
+
+    def __str__(self):
+        return ("Memory governor: %d of %d frames in flight, throttled %d "
+                "times, %.0fMB RSS of %.0fMB budget" %
+                (self.allowed, self.limit, self.throttles,
+                 self.measure() / MB, self.budget / MB))
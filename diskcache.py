@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+#
+# Persistent cache of preprocessed source frames, stored as uncompressed .npy
+# arrays that are memory-mapped back rather than decoded, so that repeated
+# runs and parallel workers share them through the page cache
+#
+
+import os
+import threading
+import numpy
+
+# Share of maxbytes an eviction frees the cache down to, so that a full cache
+# is rescanned only once in a while rather than on every store
+LOW_WATER = 0.9
+
+
+class DiskCache(object):
+
+    def __init__(self, dirname, maxbytes=4 * 1024 * 1024 * 1024):
+        self.dirname = dirname
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        # running total of the bytes stored, scanned once here and kept up to
+        # date by store() and evict()
+        self.nbytes = sum(e[1] for e in self.entries())
+
+    def path(self, key):
+        return os.path.join(self.dirname, key + ".npy")
+
+    def get(self, key, loader):
+        """Return the array stored under the hex digest KEY, mapped read-only;
+           on a miss, call LOADER for an HxWx3 array and store it first
+
+        """
+        fname = self.path(key)
+        arr = self.load(fname)
+        if arr is not None:
+            with self.lock:
+                self.hits += 1
+            try:
+                os.utime(fname)
+            except OSError:
+                pass
+            return arr
+        with self.lock:
+            self.misses += 1
+        arr = numpy.ascontiguousarray(loader())
+        self.store(fname, arr)
+        # Hand back the mapping, not the private copy, so that the pages are
+        # shared with every other process rendering from the same source
+        return self.load(fname) if os.path.exists(fname) else arr
+
+    def load(self, fname):
+        "Map FNAME read-only, or return None if it is missing or unreadable"
+        try:
+            return numpy.load(fname, mmap_mode="r")
+        except (IOError, OSError, ValueError):
+            return None
+
+    def store(self, fname, arr):
+        """Write ARR to FNAME atomically, then evict if that takes the cache
+           over the size cap
+
+        """
+        tmp = "%s.%d.%d.tmp" % (fname, os.getpid(), threading.get_ident())
+        out = open(tmp, "wb")
+        try:
+            numpy.save(out, arr)
+        finally:
+            out.close()
+        size = os.path.getsize(tmp)
+        try:
+            size -= os.path.getsize(fname)
+        except OSError:
+            pass
+        os.replace(tmp, fname)
+        with self.lock:
+            self.nbytes += size
+            full = self.nbytes > self.maxbytes
+        if full:
+            self.evict(keep=fname)
+
+    def entries(self):
+        "Return [(last use, bytes, path)] for every stored frame, oldest first"
+        ret = []
+        for name in os.listdir(self.dirname):
+            if not name.endswith(".npy"):
+                continue
+            path = os.path.join(self.dirname, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            ret.append((st.st_mtime, st.st_size, path))
+        ret.sort()
+        return ret
+
+    def evict(self, keep=None):
+        """Delete least-recently-used frames until the cache fits in LOW_WATER
+           of maxbytes, never deleting KEEP; mapped frames stay readable until
+           unmapped
+
+        """
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        for (mtime, size, path) in entries:
+            if total <= self.maxbytes * LOW_WATER:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            with self.lock:
+                self.evictions += 1
+        with self.lock:
+            # the scan also takes in what other processes have stored
+            self.nbytes = total
+
+    def __str__(self):
+        entries = self.entries()
+        return ("Disk cache %s: %d frames, %d/%d bytes, %d hits, %d misses, "
+                "%d evictions" % (self.dirname, len(entries),
+                                  sum(e[1] for e in entries), self.maxbytes,
+                                  self.hits, self.misses, self.evictions))
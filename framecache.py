@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+#
+# Size-bounded LRU cache of decoded source frames, shared between render
+# threads
+#
+
+import threading
+from collections import OrderedDict
+
+
+def frameBytes(img):
+    "Approximate number of bytes of pixel data held by IMG"
+    try:
+        return img.nbytes
+    except AttributeError:
+        w, h = img.size
+        return w * h * len(img.getbands())
+
+
+class FrameCache(object):
+
+    def __init__(self, maxbytes=1024 * 1024 * 1024):
+        self.maxbytes = maxbytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.loading = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, loader):
+        """Return the frame cached under KEY, calling LOADER to decode it on a
+           miss; concurrent requests for the same KEY decode only once
+
+        """
+        while True:
+            with self.lock:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return self.entries[key]
+                pending = self.loading.get(key)
+                if pending is None:
+                    pending = self.loading[key] = threading.Event()
+                    self.misses += 1
+                    break
+            pending.wait()
+
+        try:
+            value = loader()
+        except:
+            with self.lock:
+                self.loading.pop(key).set()
+            raise
+
+        with self.lock:
+            self.entries[key] = value
+            self.nbytes += frameBytes(value)
+            self.evict()
+            self.loading.pop(key).set()
+        return value
+
+    def evict(self):
+        "Drop least-recently-used frames until within budget; lock held"
+        while self.nbytes > self.maxbytes and len(self.entries) > 1:
+            key, value = self.entries.popitem(last=False)
+            self.nbytes -= frameBytes(value)
+            self.evictions += 1
+
+    def resize(self, maxbytes):
+        "Change the budget to MAXBYTES, evicting frames to fit at once"
+        with self.lock:
+            self.maxbytes = maxbytes
+            self.evict()
+
+    def discard(self, key):
+        "Forget the frame cached under KEY, freeing its pixels"
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.nbytes -= frameBytes(value)
+
+    def prefetch(self, items):
+        "Decode [(key, loader)] ITEMS into the cache on a background thread"
+        def run():
+            for (key, loader) in items:
+                with self.lock:
+                    if key in self.entries or key in self.loading:
+                        continue
+                try:
+                    self.get(key, loader)
+                except Exception as e:
+                    print("Prefetch of %s failed: %s" % (key, e))
+        th = threading.Thread(target=run)
+        th.daemon = True
+        th.start()
+        return th
+
+    def __str__(self):
+        return ("Frame cache: %d frames, %d/%d bytes, %d hits, %d misses, "
+                "%d evictions" % (len(self.entries), self.nbytes,
+                                  self.maxbytes, self.hits, self.misses,
+                                  self.evictions))
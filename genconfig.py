@@ -8,8 +8,8 @@
 #   ./genconfig.py 'in/*.jpg' 100 'out/' > cfg.json
 #
 
-import json, sys, os, glob
-from interpimage import *
+import json, sys, os, glob, multiprocessing
+from sourceindex import scanTimes
 
 def main():
 	pattern=""
@@ -26,10 +26,10 @@ def main():
 
 	filelist=glob.glob(pattern)
 
-	ims=sorted([ InterpImage(f) for f in filelist ], key=lambda x: x.imageCtime())
+	ims=sorted(zip(scanTimes(filelist), filelist))
 
 	data={
-	"filelist": [ {"name": f.filename, "time": f.imageCtime()} for f in ims ],
+	"filelist": [ {"name": f, "time": t} for (t, f) in ims ],
 	"inpattern": 	pattern,
 	"outdir": 		outdir,
 	"outformat": 	"png",
@@ -39,7 +39,8 @@ def main():
 	"mask": 			[],
 	"ac":   			[],
 	"rotate":			0,
-	"nothreads":	5,
+	"nothreads":	multiprocessing.cpu_count(),
+	"memory":	"auto",
 	"crop":  [[], [] ],
 	"scale": [  ]
 	}
@@ -5,11 +5,16 @@
 # includes useful methods to manipulate images on the way out
 #
 
+import math
+import os
 import time
-from os.path import getmtime
+import numpy
 from PIL import Image, ImageOps, ImageChops, ImageFilter
 from PIL.Image import blend as imageBlend
 from PIL.ExifTags import TAGS
+from tonelut import *
+from sourceindex import fileTime
+from manifest import frameHash, fileIdentity
 
 
 def lookupDef(hash, v, d=0):
@@ -20,14 +25,39 @@ def lookupDef(hash, v, d=0):
         return d
 
 
+def rotation(size, angle):
+    """Return the expanded (width, height) of an image of SIZE rotated by ANGLE
+       degrees, and the inverse affine matrix PIL's rotate() would use
+
+    """
+    w, h = size
+    a = -math.radians(angle % 360.0)
+    m = [round(math.cos(a), 15), round(math.sin(a), 15), 0.0,
+         round(-math.sin(a), 15), round(math.cos(a), 15), 0.0]
+
+    def transform(x, y):
+        return (m[0] * x + m[1] * y + m[2], m[3] * x + m[4] * y + m[5])
+
+    m[2], m[5] = transform(-w / 2.0, -h / 2.0)
+    m[2] += w / 2.0
+    m[5] += h / 2.0
+    corners = [transform(x, y) for (x, y) in ((0, 0), (w, 0), (w, h), (0, h))]
+    xx = [c[0] for c in corners]
+    yy = [c[1] for c in corners]
+    nw = int(math.ceil(max(xx)) - math.floor(min(xx)))
+    nh = int(math.ceil(max(yy)) - math.floor(min(yy)))
+    m[2], m[5] = transform(-(nw - w) / 2.0, -(nh - h) / 2.0)
+    return (nw, nh), m
+
+
 class InterpImage(object):
 
     def __init__(self, fname, t=None, gamma=None, mask=None, blur=0, ac=0.0,
-                 crop=None, scale=None, rotate=None, curves=None):
+                 crop=None, scale=None, rotate=None, curves=None, cache=None,
+                 preview=1, fused=True, disk=None):
         self.img = None
         self.filename = fname
-        if t is not None:
-            self.ctime = t
+        self.ctime = t
         self.gamma = gamma
         self.mask = mask
         self.blur = blur
@@ -36,22 +66,178 @@ class InterpImage(object):
         self.scale = scale
         self.rotate = rotate
         self.curves = curves
-        self.image = self.loadImage()
+        self.cache = cache
+        self.preview = preview
+        self.fused = fused
+        self.disk = disk
+        self.tracer = None
+        self.size = None
+
+    @property
+    def image(self):
+        "The decoded source, loaded on first use"
+        if self.cache is not None:
+            return self.cache.get(self.filename, self.loadImage)
+        if self.img is None:
+            self.img = self.loadImage()
+        return self.img
+
+    @property
+    def pixels(self):
+        "The decoded source as an HxWx3 uint8 array, loaded on first use"
+        if self.cache is not None:
+            return self.cache.get((self.filename, "pixels"), self.loadPixels)
+        return self.loadPixels()
+
+    def cacheItem(self, pixels=False):
+        "Return the (key, loader) pair under which this source is cached"
+        if pixels:
+            return ((self.filename, "pixels"), self.loadPixels)
+        return (self.filename, self.loadImage)
 
     def loadImage(self):
-        self.img = Image.open(self.filename).convert("RGB")
+        if self.disk is not None:
+            return Image.fromarray(self.loadPixels())
+        return self.decode()
+
+    def decode(self):
+        "Decode the source and apply its geometry and curves"
+        load = self.loadFused if self.fused else self.loadStepwise
+        if self.tracer is None:
+            return load()
+        with self.tracer.span("decode"):
+            img = load()
+        self.tracer.count("bytesread", os.path.getsize(self.filename))
+        return img
+
+    def loadFused(self):
+        "Load with rotate, crop and scale as a single resampling"
+        img = Image.open(self.filename)
+        full = img.size
+        rotated = full
+        if self.rotate:
+            rotated, matrix = rotation(full, self.rotate)
+        box = (0, 0) + rotated
+        if self.crop is not None:
+            box = tuple(self.crop[0] + self.crop[1])
+        out = self.frameSize()
+        reduction = min(float(box[2] - box[0]) / out[0],
+                        float(box[3] - box[1]) / out[1])
+
+        # Shed resolution cheaply first: DCT scaling for JPEGs, then an
+        # integer box reduction, leaving less than 2x for the resample
+        if reduction >= 2:
+            img.draft("RGB", (int(math.ceil(full[0] / reduction)),
+                              int(math.ceil(full[1] / reduction))))
+        factor = float(full[0]) / img.size[0]
+        img = img.convert("RGB")
+        k = int(reduction / factor)
+        if k >= 2:
+            img = img.reduce(k)
+            factor *= k
+
+        if not self.rotate:
+            img = img.resize(out, Image.LANCZOS,
+                             box=tuple(c / factor for c in box))
+        else:
+            # output -> crop box in rotated frame -> source, all in one pass
+            sx = float(box[2] - box[0]) / out[0]
+            sy = float(box[3] - box[1]) / out[1]
+            a, b, c, d, e, f = matrix
+            img = img.transform(out, Image.AFFINE,
+                                (a * sx / factor, b * sy / factor,
+                                 (a * box[0] + b * box[1] + c) / factor,
+                                 d * sx / factor, e * sy / factor,
+                                 (d * box[0] + e * box[1] + f) / factor),
+                                Image.BICUBIC if reduction > 1 else
+                                Image.BILINEAR)
         if self.curves is not None:
-            self.img = self.img.point(self.curves)
+            img = img.point(list(self.curves))
+        return img
+
+    def loadStepwise(self):
+        "Load with separate curves, rotate, crop and scale steps"
+        img = Image.open(self.filename)
+        fullwidth = img.size[0]
+        if self.preview > 1:
+            img.draft("RGB", (img.size[0] // self.preview,
+                              img.size[1] // self.preview))
+        factor = float(fullwidth) / img.size[0]
+        img = img.convert("RGB")
+        if self.curves is not None:
+            img = img.point(list(self.curves))
         if self.rotate is not None:
-            self.img = self.img.rotate(self.rotate, Image.BILINEAR, True)
-        if self.crop is not None:
-            print("crop %s" % self.crop)
-            self.img = self.img.crop(tuple(self.crop[0] + self.crop[1]))
-            self.img.load()
+            img = img.rotate(self.rotate, Image.BILINEAR, True)
+        return self.fitGeometry(img, factor)
+
+    def outputSize(self):
+        "Return the full-resolution (width, height) of the loaded image"
         if self.scale is not None:
-            self.img = self.img.resize(tuple(self.scale), Image.ANTIALIAS)
+            return tuple(self.scale)
+        if self.crop is not None:
+            return (self.crop[1][0] - self.crop[0][0],
+                    self.crop[1][1] - self.crop[0][1])
+        return self.sourceSize()
 
-        return self.img
+    def frameSize(self):
+        """Return the (width, height) of the loaded image, reduced for preview,
+           from the file header
+
+        """
+        if self.size is None:
+            w, h = self.outputSize()
+            self.size = (max(1, w // self.preview), max(1, h // self.preview))
+        return self.size
+
+    def sourceSize(self):
+        "Return the (width, height) of the source after rotation"
+        size = Image.open(self.filename).size
+        if self.rotate:
+            size = rotation(size, self.rotate)[0]
+        return size
+
+    def fitGeometry(self, img, factor=1.0):
+        """Apply crop and scale to IMG, an image the size of the rotated source
+           reduced by FACTOR
+
+        """
+        if self.crop is not None:
+            img = img.crop(tuple(int(round(c / factor))
+                                 for c in self.crop[0] + self.crop[1]))
+            img.load()
+        if img.size != self.frameSize():
+            img = img.resize(self.frameSize(), Image.LANCZOS)
+        return img
+
+    def loadPixels(self):
+        if self.disk is not None:
+            return self.disk.get(self.diskKey(),
+                                 lambda: numpy.asarray(self.decode()))
+        return numpy.asarray(self.loadImage())
+
+    def diskKey(self):
+        """Return the disk cache key: the source file's identity and every
+           parameter that shapes the decoded pixels
+
+        """
+        return frameHash((fileIdentity(self.filename), self.crop, self.scale,
+                          self.rotate, self.curves and tuple(self.curves),
+                          self.preview, self.fused))
+
+    def statsKey(self):
+        "Return the key of this source's histogram stats in the index"
+        return frameHash((self.crop, self.scale, self.rotate,
+                          self.curves and tuple(self.curves), self.fused))[:16]
+
+    def statsPixels(self):
+        """Return the source as loaded but at a quarter of the size, as an
+           HxWx3 uint8 array for histogram statistics
+
+        """
+        small = InterpImage(self.filename, crop=self.crop, scale=self.scale,
+                            rotate=self.rotate, curves=self.curves,
+                            preview=4, fused=self.fused)
+        return numpy.asarray(small.decode())
 
     def get_exif(self):
         "Return a hash of EXIF info for the current image"
@@ -70,34 +256,14 @@ class InterpImage(object):
 
     def imageCtime(self):
         "Return either the EXIF image-creation date if possible or file mtime"
-        try:
-            exif = self.get_exif()
-            timestr = lookupDef(exif, "DateTimeOriginal",
-                                lookupDef(exif, "DateTime",
-                                          lookupDef(exif, "DateTimeDigitized",
-                                                    getmtime(self.filename))))
-        except:
-            timestr = getmtime(self.filename)
-
-        try:
-            if type(timestr) == float:
-                ret = timestr
-            else:
-                ret = time.mktime(time.strptime(timestr, "%Y:%m:%d %H:%M:%S"))
-        except ValueError:
-            if type(timestr) == float:
-                ret = timestr
-            else:
-                ret = time.mktime(time.strptime(timestr, "%Y-%m-%dT%H:%M:%S"))
-        self.ctime = ret
+        if self.ctime is not None:
+            return self.ctime
+        self.ctime = fileTime(self.filename)
         return self.ctime
 
     def interp(self, other, r):
         "Interpolate r proportion of the way between this and another image"
         try:
-            print("image %s" % self.image)
-            print("other %s" % other)
-            print("rem %s" % r)
             ret = imageBlend(self.image, other.image, r).convert("RGB")
         except ValueError:
             print("Eeeek! Failed to blend %s and %s" %
@@ -108,11 +274,10 @@ class InterpImage(object):
 
     def reap(self):
         "unload image from memory"
-        try:
-            if self.img is not None:
-                del(self.img)
-        except AttributeError:
-            pass
+        self.img = None
+        if self.cache is not None:
+            self.cache.discard(self.filename)
+            self.cache.discard((self.filename, "pixels"))
 
     def __str__(self):
         "Return a string representation of self S"
@@ -127,18 +292,7 @@ class InterpImage(object):
 
 def imageGamma(img, g=(1.0, 1.0, 1.0), depth=256):
     "Apply a gamma curve to image"
-    ret = img
-    if g != (1.0, 1.0, 1.0):
-        (rg, gg, bg) = g
-        rtable = map(lambda x: int(depth * (float(x) / depth) ** (1.0 / rg)),
-                     range(depth))
-        gtable = map(lambda x: int(depth * (float(x) / depth) ** (1.0 / gg)),
-                     range(depth))
-        btable = map(lambda x: int(depth * (float(x) / depth) ** (1.0 / bg)),
-                     range(depth))
-        table = rtable + gtable + btable
-        ret = img.point(table)
-    return ret
+    return imageTone(img, g)
 
 
 def imageMask(img, mask):
@@ -148,9 +302,21 @@ def imageMask(img, mask):
         return img
 
 
-def imageBlur(img, degree):
+# Per-axis variance of one pass of ImageFilter.BLUR's 5x5 ring kernel
+BLUR_VARIANCE = 2.75
+
+
+def imageBlur(img, degree, fast=True):
+    """Blur IMG as much as DEGREE passes of ImageFilter.BLUR would; the fast
+       path is a Gaussian of the same variance, whose cost does not depend on
+       DEGREE
+
+    """
     if degree == 0.0:
         return img
+    elif fast:
+        return img.filter(ImageFilter.GaussianBlur(
+            math.sqrt(BLUR_VARIANCE * degree)))
     else:
         for i in range(int(degree)):
             img = img.filter(ImageFilter.BLUR)
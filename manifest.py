@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+#
+# Render manifest: a hash of the resolved inputs of every frame written, so
+# that a rerun need only render frames whose inputs changed
+#
+
+import hashlib
+import json
+import os
+import threading
+
+MANIFEST_NAME = "manifest.jsonl"
+
+# Trailing bytes of a completely written file, by extension
+TRAILERS = {
+    "png": b"IEND\xaeB`\x82",
+    "jpg": b"\xff\xd9",
+    "jpeg": b"\xff\xd9",
+}
+
+
+def frameHash(key):
+    "Return a hex digest of the frame parameter tuple KEY"
+    return hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+
+
+def fileIdentity(fname):
+    "Return (path, size, mtime) identifying the current contents of FNAME"
+    st = os.stat(fname)
+    return (os.path.abspath(fname), st.st_size, st.st_mtime)
+
+
+def frameComplete(fname):
+    "Return whether FNAME exists and, where the format allows, is not truncated"
+    try:
+        size = os.path.getsize(fname)
+    except OSError:
+        return False
+    trailer = TRAILERS.get(fname.rsplit(".", 1)[-1].lower(), b"")
+    if size <= len(trailer):
+        return False
+    if trailer:
+        f = open(fname, "rb")
+        f.seek(-len(trailer), 2)
+        ok = f.read() == trailer
+        f.close()
+        return ok
+    return True
+
+
+class Manifest(object):
+    """Frame number to input hash, appended a line at a time so that it
+       survives an interrupted render"""
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.hashes = {}
+        self.lock = threading.Lock()
+        try:
+            for line in open(fname, "r"):
+                try:
+                    entry = json.loads(line)
+                    self.hashes[entry["frame"]] = entry["hash"]
+                except (ValueError, KeyError):
+                    pass
+        except IOError:
+            pass
+        self.out = open(fname, "a")
+
+    def get(self, n):
+        return self.hashes.get(n)
+
+    def record(self, n, h):
+        "Note that frame N was written from inputs hashing to H"
+        with self.lock:
+            self.hashes[n] = h
+            self.out.write(json.dumps({"frame": n, "hash": h}) + "\n")
+            self.out.flush()
+
+    def close(self, noframes=None):
+        "Rewrite the manifest compactly, dropping frames beyond NOFRAMES"
+        self.out.close()
+        tmp = self.fname + ".tmp"
+        out = open(tmp, "w")
+        for n in sorted(self.hashes):
+            if noframes is None or n < noframes:
+                out.write(json.dumps({"frame": n, "hash": self.hashes[n]}) +
+                          "\n")
+        out.close()
+        os.replace(tmp, self.fname)
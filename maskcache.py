@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+#
+# Mask images decoded once and fitted to the output frame geometry, with the
+# blend between the current pair of mask keyframes kept between frames
+#
+
+import threading
+import numpy
+from PIL import Image
+
+
+class MaskCache(object):
+
+    def __init__(self, fnames, source):
+        """Load each mask in FNAMES, fitted to the frames produced by the
+           InterpImage SOURCE (reduced if it is a preview); raises ValueError
+           for a mask of the wrong size
+
+        """
+        self.size = source.frameSize()
+        self.images = {}
+        self.arrays = {}
+        self.pair = None
+        self.lock = threading.Lock()
+        srcsize = None
+        for fname in fnames:
+            img = Image.open(fname).convert("RGB")
+            if img.size != self.size and img.size == source.outputSize():
+                img = img.resize(self.size, Image.LANCZOS)
+            if img.size != self.size:
+                if srcsize is None:
+                    srcsize = source.sourceSize()
+                if img.size != srcsize:
+                    raise ValueError("Mask %s is %dx%d; expected %dx%d or "
+                                     "the %dx%d source size" %
+                                     ((fname,) + img.size +
+                                      source.outputSize() + srcsize))
+                img = source.fitGeometry(img)
+            self.images[fname] = img
+
+    def pixels(self, fname):
+        "Return mask FNAME as an HxWx3 uint8 array"
+        arr = self.arrays.get(fname)
+        if arr is None:
+            arr = self.arrays[fname] = numpy.asarray(self.images[fname])
+        return arr
+
+    def image(self, m1, m2, factor):
+        "Return masks M1 and M2 blended by FACTOR, or None if either is missing"
+        if m1 is None or m2 is None:
+            return None
+        if m1 == m2 or factor == 0.0:
+            return self.images[m1]
+        if factor == 1.0:
+            return self.images[m2]
+        return Image.fromarray(self.blend(m1, m2, factor))
+
+    def array(self, m1, m2, factor):
+        "As image(), but returning an HxWx3 uint8 array"
+        if m1 is None or m2 is None:
+            return None
+        if m1 == m2 or factor == 0.0:
+            return self.pixels(m1)
+        if factor == 1.0:
+            return self.pixels(m2)
+        return self.blend(m1, m2, factor)
+
+    def blend(self, m1, m2, factor):
+        """Blend masks M1 and M2 as Image.blend would, from the difference
+           image kept for the current keyframe pair
+
+        """
+        with self.lock:
+            if self.pair is None or self.pair[0] != (m1, m2):
+                a = self.pixels(m1)
+                diff = self.pixels(m2).astype(numpy.float32) - a
+                self.pair = ((m1, m2), a, diff, {})
+            key, a, diff, blends = self.pair
+            ret = blends.get(factor)
+        if ret is None:
+            work = diff * numpy.float32(factor)
+            work += a
+            numpy.clip(work, 0, 255, out=work)
+            ret = work.astype(numpy.uint8)
+            with self.lock:
+                if self.pair[0] == key:
+                    blends.clear()
+                    blends[factor] = ret
+        return ret
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+#
+# Fused NumPy pixel engine: blend, auto-contrast mix, mask multiply and gamma
+# for one output frame, computed into reusable buffers instead of a new PIL
+# image per stage. Results match the PIL chain in interpimage to within 1.
+#
+
+import numpy
+from PIL import Image
+
+CHANNEL_OFFSETS = numpy.array([0, 256, 512], dtype=numpy.uint16)
+
+
+def autocontrastTable(hist):
+    """Return the (3,256) per-channel lookup table ImageOps.autocontrast would
+       build from the (3,256) histogram HIST
+
+    """
+    ramp = numpy.arange(256, dtype=numpy.float64)
+    table = numpy.empty((3, 256), dtype=numpy.int64)
+    for c in range(3):
+        nz = numpy.nonzero(hist[c])[0]
+        if len(nz) == 0 or nz[-1] <= nz[0]:
+            table[c] = ramp
+            continue
+        lo, hi = nz[0], nz[-1]
+        scale = 255.0 / (hi - lo)
+        table[c] = numpy.clip((ramp * scale - lo * scale).astype(numpy.int64),
+                              0, 255)
+    return table
+
+
+def mixTable(table, r):
+    """Return the table mapping x to a PIL-style blend of x and TABLE[x] by
+       proportion R, truncated and clipped as Image.blend does
+
+    """
+    x = numpy.arange(256, dtype=numpy.float32)
+    mixed = x + numpy.float32(r) * (table.astype(numpy.float32) - x)
+    return numpy.clip(mixed, 0, 255).astype(numpy.int64)
+
+
+class FusedEngine(object):
+    """Pixel pipeline holding its working buffers between frames; to be used
+       by one thread at a time"""
+
+    def __init__(self):
+        self.shape = None
+
+    def buffers(self, shape):
+        "(Re)allocate the working buffers for frames of SHAPE"
+        if self.shape != shape:
+            self.shape = shape
+            self.work = numpy.empty(shape, dtype=numpy.float32)
+            self.out = numpy.empty(shape, dtype=numpy.uint8)
+            self.idx = numpy.empty(shape, dtype=numpy.uint16)
+            self.prod = numpy.empty(shape, dtype=numpy.uint32)
+
+    def blend(self, a, b, r):
+        "Blend uint8 arrays A and B by R into self.out"
+        if r == 0.0:
+            numpy.copyto(self.out, a)
+        elif r == 1.0:
+            numpy.copyto(self.out, b)
+        else:
+            numpy.subtract(b, a, out=self.work, dtype=numpy.float32)
+            self.work *= numpy.float32(r)
+            self.work += a
+            numpy.clip(self.work, 0, 255, out=self.work)
+            numpy.copyto(self.out, self.work, casting="unsafe")
+
+    def lookup(self, table):
+        "Map self.out through the (3,256) TABLE in place"
+        numpy.add(self.out, CHANNEL_OFFSETS, out=self.idx)
+        numpy.take(table.astype(numpy.uint8).ravel(), self.idx, out=self.out)
+
+    def multiply(self, mask):
+        "Multiply self.out by uint8 MASK as ImageChops.multiply does"
+        numpy.multiply(self.out, mask, out=self.prod, dtype=numpy.uint32)
+        self.prod //= 255
+        numpy.copyto(self.out, self.prod, casting="unsafe")
+
+    def render(self, a, b, r, ac=0.0, mask=None, gamma=None, levels=None):
+        """Return a PIL image of sources A,B blended by R, mapped through the
+           (3,256) LEVELS table, auto-contrast mixed by AC, multiplied by MASK
+           and mapped through the (3,256) GAMMA table
+
+        """
+        self.buffers(a.shape)
+        self.blend(a, b, r)
+        table = levels
+        if ac != 0.0:
+            if table is not None:
+                self.lookup(table)
+            hist = numpy.stack([numpy.bincount(self.out[..., c].ravel(),
+                                               minlength=256)
+                                for c in range(3)])
+            table = numpy.stack([mixTable(t, ac)
+                                 for t in autocontrastTable(hist)])
+        if mask is not None:
+            if table is not None:
+                self.lookup(table)
+                table = None
+            self.multiply(mask)
+        if gamma is not None:
+            if table is not None:
+                gamma = numpy.take_along_axis(gamma, table, axis=1)
+            table = gamma
+        if table is not None:
+            self.lookup(table)
+        return Image.fromarray(self.out)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+#
+# Compiled render plan for a Timeline: every per-frame parameter worked out
+# once, up front, from sorted keyframe arrays
+#
+
+import json
+import numpy
+
+
+def keyframeIndex(times, t, side="left"):
+    """Return the keyframe interval index for each time T and the proportion
+       of the way through that interval
+
+    """
+    times = numpy.asarray(times, dtype=numpy.float64)
+    t = numpy.asarray(t, dtype=numpy.float64)
+    idx = numpy.searchsorted(times, t, side=side) - 1
+    idx = numpy.clip(idx, 0, max(len(times) - 2, 0))
+    nxt = numpy.minimum(idx + 1, len(times) - 1)
+    diff = times[nxt] - times[idx]
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        r = numpy.where(diff > 0, (t - times[idx]) / diff, 0.0)
+    return idx, numpy.clip(r, 0.0, 1.0)
+
+
+def gammaTriple(g):
+    "Normalise a gamma keyframe value to an (r,g,b) triple"
+    if isinstance(g, (list, tuple)):
+        return tuple(float(x) for x in g)
+    return (float(g), float(g), float(g))
+
+
+def interpTrack(track, t, side="left"):
+    """Linearly interpolate a sorted [(time, value)] keyframe track at times T;
+       values may be scalars or tuples
+
+    """
+    times = [k[0] for k in track]
+    values = numpy.asarray([k[1] for k in track], dtype=numpy.float64)
+    idx, r = keyframeIndex(times, t, side)
+    nxt = numpy.minimum(idx + 1, len(times) - 1)
+    if values.ndim > 1:
+        r = r[..., numpy.newaxis]
+    return values[idx] + (values[nxt] - values[idx]) * r
+
+
+class RenderPlan(object):
+    "Per-frame source, blend, gamma, blur, ac and mask parameters"
+
+    def __init__(self, timeline, noframes=None):
+        if noframes is None:
+            noframes = timeline.noframes
+        self.noframes = noframes
+        self.filenames = [f.filename for f in timeline.filelist]
+        ftimes = numpy.asarray(timeline.fileTimes(), dtype=numpy.float64)
+        mint, maxt = ftimes[0], ftimes[-1]
+        if timeline.frameinterval:
+            self.times = (numpy.arange(noframes, dtype=numpy.float64) *
+                          timeline.frameinterval + mint)
+        else:
+            self.times = (numpy.arange(noframes, dtype=numpy.float64) /
+                          noframes * (maxt - mint) + mint)
+
+        self.source, self.ratio = keyframeIndex(ftimes, self.times)
+        self.gamma = interpTrack([(t, gammaTriple(g))
+                                  for (t, g) in timeline.gammas], self.times)
+        self.blur = interpTrack(timeline.blur, self.times)
+        self.ac = interpTrack(timeline.ac, self.times)
+
+        self.maskfiles = sorted(set(m for (t, m) in timeline.masks
+                                    if m is not None))
+        lookup = dict((m, i) for (i, m) in enumerate(self.maskfiles))
+        mtimes = [t for (t, m) in timeline.masks]
+        mids = numpy.asarray([lookup.get(m, -1) for (t, m) in timeline.masks],
+                             dtype=numpy.int64)
+        idx, self.maskfactor = keyframeIndex(mtimes, self.times, side="right")
+        self.mask1 = mids[idx]
+        self.mask2 = mids[numpy.minimum(idx + 1, len(mids) - 1)]
+        unmasked = (self.mask1 < 0) | (self.mask2 < 0)
+        self.mask1[unmasked] = -1
+        self.mask2[unmasked] = -1
+        self.maskfactor[unmasked] = 0.0
+
+    def __len__(self):
+        return self.noframes
+
+    def frame(self, n):
+        "Return a dict of the resolved parameters for frame N"
+        m1, m2 = int(self.mask1[n]), int(self.mask2[n])
+        return {
+            "frame": n,
+            "time": float(self.times[n]),
+            "source": int(self.source[n]),
+            "ratio": float(self.ratio[n]),
+            "gamma": tuple(float(g) for g in self.gamma[n]),
+            "blur": float(self.blur[n]),
+            "ac": float(self.ac[n]),
+            "mask1": self.maskfiles[m1] if m1 >= 0 else None,
+            "mask2": self.maskfiles[m2] if m2 >= 0 else None,
+            "maskfactor": float(self.maskfactor[n]),
+        }
+
+    def segments(self, first=0, last=None):
+        """Yield (source, start, stop) runs of consecutive frames in
+           [FIRST, LAST) that blend the same source pair
+
+        """
+        if last is None:
+            last = self.noframes
+        start = first
+        for n in range(first + 1, last + 1):
+            if n == last or self.source[n] != self.source[start]:
+                yield (int(self.source[start]), start, n)
+                start = n
+
+    def arrays(self):
+        "Return a dict of the per-frame parameter arrays"
+        return {
+            "time": self.times,
+            "source": self.source,
+            "ratio": self.ratio,
+            "gamma": self.gamma,
+            "blur": self.blur,
+            "ac": self.ac,
+            "mask1": self.mask1,
+            "mask2": self.mask2,
+            "maskfactor": self.maskfactor,
+        }
+
+    def save(self, fname):
+        "Dump the plan to FNAME, as NPZ if it ends .npz otherwise as JSON"
+        if fname.endswith(".npz"):
+            numpy.savez(fname, filenames=numpy.asarray(self.filenames),
+                        maskfiles=numpy.asarray(self.maskfiles, dtype=str),
+                        **self.arrays())
+            return
+        data = dict((k, v.tolist()) for (k, v) in self.arrays().items())
+        data["filenames"] = self.filenames
+        data["maskfiles"] = self.maskfiles
+        data["noframes"] = self.noframes
+        out = open(fname, "w")
+        out.write(json.dumps(data, indent=2, sort_keys=True))
+        out.close()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+#
+# Sharded rendering: a deterministic split of the frames between machines
+# sharing the output directory, each shard keeping its own manifest and a
+# completion record, and a check that the shards together make up the whole
+#
+
+import glob
+import json
+import os
+import socket
+import time
+
+from manifest import MANIFEST_NAME, Manifest, frameComplete, frameHash
+
+
+def parseShard(spec, noframes):
+    """Return the [first, last) frame range of shard "I/N", I counting from 1,
+       the Ith of N contiguous ranges as near equal as can be
+
+    """
+    try:
+        (i, n) = [int(x) for x in spec.split("/")]
+    except ValueError:
+        raise ValueError("shard must be I/N: %s" % spec)
+    if not 1 <= i <= n:
+        raise ValueError("shard %d/%d: I must be from 1 to N" % (i, n))
+    return ((i - 1) * noframes // n, i * noframes // n)
+
+
+def parseFrames(spec, noframes):
+    "Return the [first, last) frame range \"A:B\", either end omitted for all"
+    try:
+        (a, b) = spec.split(":")
+        first = int(a) if a else 0
+        last = int(b) if b else noframes
+    except ValueError:
+        raise ValueError("frame range must be A:B: %s" % spec)
+    if not 0 <= first < last <= noframes:
+        raise ValueError("frame range %d:%d is not within 0:%d" %
+                         (first, last, noframes))
+    return (first, last)
+
+
+def shardName(first, last):
+    "Return the stem naming the files of the shard rendering [FIRST, LAST)"
+    return "shard-%05d-%05d" % (first, last)
+
+
+def planHash(hashes):
+    "Return a hash of the input hashes of every frame of the timeline"
+    return frameHash(tuple(hashes))
+
+
+def writeShardRecord(outdir, first, last, hashes, rendered):
+    "Note in OUTDIR that the shard [FIRST, LAST) is complete"
+    record = {
+        "first": first,
+        "last": last,
+        "plan": planHash(hashes),
+        "noframes": len(hashes),
+        "rendered": rendered,
+        "host": socket.gethostname(),
+        "finished": time.time(),
+    }
+    fname = os.path.join(outdir, shardName(first, last) + ".json")
+    tmp = fname + ".tmp"
+    json.dump(record, open(tmp, "w"), indent=1)
+    os.replace(tmp, fname)
+    return fname
+
+
+def readManifests(outdir):
+    "Return frame number to hash from the main and every shard manifest"
+    hashes = {}
+    for fname in ([os.path.join(outdir, MANIFEST_NAME)] +
+                  sorted(glob.glob(os.path.join(outdir,
+                                                "shard-*-*.jsonl")))):
+        for line in (open(fname) if os.path.exists(fname) else []):
+            try:
+                entry = json.loads(line)
+                hashes[entry["frame"]] = entry["hash"]
+            except (ValueError, KeyError):
+                pass
+    return hashes
+
+
+def verifyShards(tl):
+    """Check that every frame of timeline TL is in its output directory,
+       complete and recorded as rendered from the current inputs, and that
+       every shard was rendered from the current plan; returns a list of the
+       problems found
+
+    """
+    hashes = tl.frameHashes()
+    plan = planHash(hashes)
+    problems = []
+    for fname in sorted(glob.glob(os.path.join(tl.outdir, "shard-*-*.json"))):
+        record = json.load(open(fname))
+        if record["plan"] != plan:
+            problems.append("%s: frames %d-%d rendered on %s from a "
+                            "different config or inputs" %
+                            (os.path.basename(fname), record["first"],
+                             record["last"] - 1, record["host"]))
+    recorded = readManifests(tl.outdir)
+    missing, stale = [], []
+    for n in range(tl.noframes):
+        if not frameComplete(tl.frameName(n)):
+            missing.append(n)
+        elif recorded.get(n) != hashes[n]:
+            stale.append(n)
+    if missing:
+        problems.append("%d frames missing or incomplete: %s" %
+                        (len(missing), frameList(missing)))
+    if stale:
+        problems.append("%d frames rendered from different inputs: %s" %
+                        (len(stale), frameList(stale)))
+    return problems
+
+
+def mergeShards(tl):
+    """Fold the shard manifests of timeline TL into its main manifest and
+       remove them with the shard records
+
+    """
+    shards = sorted(glob.glob(os.path.join(tl.outdir, "shard-*-*.json*")))
+    recorded = readManifests(tl.outdir)
+    manifest = Manifest(os.path.join(tl.outdir, MANIFEST_NAME))
+    manifest.hashes.update(recorded)
+    manifest.close(tl.noframes)
+    for fname in shards:
+        os.remove(fname)
+    return len([f for f in shards if f.endswith(".json")])
+
+
+def frameList(frames, limit=10):
+    "Format FRAMES as ranges a-b, at most LIMIT of them"
+    ranges = []
+    for n in frames:
+        if ranges and ranges[-1][1] == n - 1:
+            ranges[-1][1] = n
+        else:
+            ranges.append([n, n])
+    s = ", ".join(str(a) if a == b else "%d-%d" % (a, b)
+                  for (a, b) in ranges[:limit])
+    if len(ranges) > limit:
+        s += ", ..."
+    return s
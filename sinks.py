@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+
+#
+# Output sinks for rendered frames: a numbered image sequence, a YUV4MPEG2
+# stream to a file or stdout, or a pipe into a local encoder
+#
+
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+
+def discard(fname):
+    "Remove FNAME if present, so that rewriting it cannot alter a file linked to it"
+    try:
+        os.remove(fname)
+    except OSError:
+        pass
+
+
+class EncoderPool(object):
+    """Threads running SAVE(n, img) on frames handed over by the renderers;
+       at most two frames per thread wait, so that a slow encoder holds the
+       renderers back rather than letting frames pile up in memory"""
+
+    def __init__(self, nthreads, save):
+        self.save = save
+        self.queue = queue.Queue(2 * nthreads)
+        self.errors = []
+        self.threads = [threading.Thread(target=self.run)
+                        for i in range(nthreads)]
+        for th in self.threads:
+            th.daemon = True
+            th.start()
+
+    def put(self, n, img):
+        if self.errors:
+            raise self.errors[0]
+        self.queue.put((n, img))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                self.save(*item)
+            except Exception as e:
+                self.errors.append(e)
+
+    def close(self):
+        "Wait for every queued frame to be saved, raising the first failure"
+        for th in self.threads:
+            self.queue.put(None)
+        for th in self.threads:
+            th.join()
+        if self.errors:
+            raise self.errors[0]
+
+
+class ImageSequenceSink(object):
+    """Save each frame as its own file, named by PATTERN % frame number, with
+       PIL save OPTIONS, on ENCODERS background threads if non-zero; DONE is
+       called with the number of each frame once its file is fully written"""
+
+    def __init__(self, pattern, options=None, encoders=0, done=None):
+        self.pattern = pattern
+        self.options = options or {}
+        self.done = done
+        self.frames = 0
+        self.bytes = 0
+        self.encodetime = 0.0
+        self.tracer = None
+        self.repeats = []
+        self.repeated = 0
+        self.lock = threading.Lock()
+        self.pool = None
+        if encoders:
+            self.pool = EncoderPool(encoders, self.save)
+
+    def filename(self, n):
+        return self.pattern % n
+
+    def write(self, n, img):
+        "Save frame N, or queue it for the encoders; any order will do"
+        if self.pool is not None:
+            self.pool.put(n, img)
+        else:
+            self.save(n, img)
+
+    def save(self, n, img):
+        start = time.time()
+        discard(self.filename(n))
+        try:
+            img.save(self.filename(n), **self.options)
+        except:
+            # leave no partial file to be mistaken for a finished one
+            discard(self.filename(n))
+            raise
+        end = time.time()
+        size = os.path.getsize(self.filename(n))
+        with self.lock:
+            self.bytes += size
+            self.frames += 1
+            self.encodetime += end - start
+        if self.tracer is not None:
+            self.tracer.add("encode", start, end)
+        if self.done is not None:
+            self.done(n)
+
+    def skip(self, n):
+        "Note that frame N will not be written"
+        pass
+
+    def repeat(self, n, source, copy=False):
+        """Make frame N a hard link to frame SOURCE, or to the file SOURCE if
+           a filename, or with COPY a copy, once every frame is saved
+
+        """
+        discard(self.filename(n))
+        self.repeats.append((n, source, copy))
+
+    def link(self, n, source, copy):
+        fname = self.filename(n)
+        if not isinstance(source, str):
+            source = self.filename(source)
+        discard(fname)
+        if not copy:
+            try:
+                os.link(source, fname)
+                return
+            except OSError:
+                pass
+        shutil.copyfile(source, fname)
+        self.bytes += os.path.getsize(fname)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+        for (n, source, copy) in self.repeats:
+            self.link(n, source, copy)
+            self.frames += 1
+            self.repeated += 1
+            if self.done is not None:
+                self.done(n)
+        self.repeats = []
+
+    def __str__(self):
+        return "image sequence %s: %d frames" % (self.pattern, self.frames)
+
+
+class StreamSink(object):
+    """Base for sinks that need frames in order: frames arriving early are held
+       until their turn, and writers more than WINDOW frames ahead block"""
+
+    def __init__(self, window=32, first=0):
+        self.window = window
+        self.next = first
+        self.pending = {}
+        self.cond = threading.Condition()
+        self.frames = 0
+        self.bytes = 0
+        self.encodetime = 0.0
+        self.tracer = None
+        self.repeats = {}
+        self.held = {}
+        self.refs = {}
+        self.repeated = 0
+
+    def write(self, n, img):
+        "Queue frame N, emitting every frame now due"
+        with self.cond:
+            while n >= self.next + self.window:
+                self.cond.wait()
+            self.pending[n] = img
+            self.flush()
+
+    def skip(self, n):
+        "Note that frame N will not be written, so later frames can proceed"
+        with self.cond:
+            self.pending[n] = None
+            self.flush()
+
+    def repeat(self, n, source, copy=False):
+        "Emit frame SOURCE again as frame N, keeping it until then"
+        with self.cond:
+            self.repeats[n] = source
+            self.refs[source] = self.refs.get(source, 0) + 1
+
+    def release(self, source):
+        "Return the kept frame SOURCE for one of its repeats; condition held"
+        img = self.held.get(source)
+        self.refs[source] -= 1
+        if not self.refs[source]:
+            del self.refs[source]
+            self.held.pop(source, None)
+        return img
+
+    def flush(self):
+        "Emit consecutive frames from self.next; condition held"
+        while self.next in self.pending or self.next in self.repeats:
+            if self.next in self.repeats:
+                img = self.release(self.repeats.pop(self.next))
+                if img is not None:
+                    self.repeated += 1
+            else:
+                img = self.pending.pop(self.next)
+                if img is not None and self.next in self.refs:
+                    self.held[self.next] = img
+            if img is not None:
+                start = time.time()
+                self.emit(img)
+                end = time.time()
+                self.encodetime += end - start
+                if self.tracer is not None:
+                    self.tracer.add("encode", start, end)
+                self.frames += 1
+            self.next += 1
+        self.cond.notify_all()
+
+    def emit(self, img):
+        raise NotImplementedError
+
+
+class Y4MSink(StreamSink):
+    "Write frames as a YUV4MPEG2 (4:4:4, full range) stream"
+
+    def __init__(self, out, fps=25, window=32, first=0):
+        StreamSink.__init__(self, window, first)
+        self.out = out
+        self.fps = fps
+        self.header = False
+
+    def emit(self, img):
+        if not self.header:
+            header = ("YUV4MPEG2 W%d H%d F%d:1 Ip A1:1 C444 "
+                      "XCOLORRANGE=FULL\n" %
+                      (img.size + (self.fps,))).encode("ascii")
+            self.out.write(header)
+            self.bytes += len(header)
+            self.header = True
+        self.out.write(b"FRAME\n")
+        self.bytes += 6
+        for band in img.convert("YCbCr").split():
+            data = band.tobytes()
+            self.out.write(data)
+            self.bytes += len(data)
+
+    def close(self):
+        self.out.close()
+
+    def __str__(self):
+        return "YUV4MPEG2 stream: %d frames" % self.frames
+
+
+class PipeSink(Y4MSink):
+    "Feed a YUV4MPEG2 stream to the standard input of shell command CMD"
+
+    def __init__(self, cmd, fps=25, window=32, first=0):
+        self.cmd = cmd
+        self.proc = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE)
+        Y4MSink.__init__(self, self.proc.stdin, fps, window, first)
+
+    def close(self):
+        self.out.close()
+        if self.proc.wait() != 0:
+            raise IOError("Encoder command failed with status %d: %s" %
+                          (self.proc.returncode, self.cmd))
+
+    def __str__(self):
+        return "pipe to [%s]: %d frames" % (self.cmd, self.frames)
+
+
+_stdout = None
+
+
+def stdoutStream():
+    """Return a binary stream onto the real stdout, pointing file descriptor 1
+       at stderr on first use so that progress messages cannot corrupt it
+
+    """
+    global _stdout
+    if _stdout is None or _stdout.closed:
+        sys.stdout.flush()
+        _stdout = os.fdopen(os.dup(1), "wb")
+        os.dup2(2, 1)
+    return _stdout
+
+
+def parseOptions(spec):
+    """Return PIL save options from SPEC, "name=value,...", with numbers and
+       true/false converted
+
+    """
+    options = {}
+    for item in filter(None, (spec or "").split(",")):
+        (name, value) = item.split("=", 1)
+        if value.lower() in ("true", "false"):
+            value = value.lower() == "true"
+        else:
+            try:
+                value = int(value)
+            except ValueError:
+                pass
+        options[name.strip()] = value
+    return options
+
+
+def openSink(spec, pattern, fps=25, window=32, first=0, options=None,
+             encoders=0, done=None):
+    """Open the sink described by SPEC: None for an image sequence named by
+       PATTERN, saved with PIL OPTIONS on ENCODERS threads and reported to
+       DONE as each is written, "|command" for a pipe, "-" or "*.y4m" for a
+       YUV4MPEG2 stream
+
+    """
+    if not spec:
+        return ImageSequenceSink(pattern, options, encoders, done)
+    if spec.startswith("|"):
+        return PipeSink(spec[1:].strip(), fps, window, first)
+    if spec == "-":
+        return Y4MSink(stdoutStream(), fps, window, first)
+    if spec.endswith(".y4m"):
+        return Y4MSink(open(spec, "wb"), fps, window, first)
+    raise ValueError("Unknown output sink: %s" % spec)
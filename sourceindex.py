@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+#
+# Header-only EXIF timestamp scanner, with a per-directory sidecar index so
+# unchanged files need not be opened again
+#
+
+import json
+import os
+import struct
+import time
+from multiprocessing.dummy import Pool as ThreadPool
+
+INDEX_NAME = ".timelapse-index.json"
+
+# TIFF tags of interest, by IFD
+IFD0_TAGS = {0x0132: "DateTime", 0x8769: "ExifOffset"}
+EXIF_TAGS = {0x9003: "DateTimeOriginal", 0x9004: "DateTimeDigitized"}
+
+TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8}
+
+
+def readIfd(f, base, offset, order, wanted):
+    "Read the WANTED tags of the TIFF IFD at OFFSET, relative to BASE"
+    ret = {}
+    f.seek(base + offset)
+    count = struct.unpack(order + "H", f.read(2))[0]
+    entries = f.read(count * 12)
+    for i in range(count):
+        tag, typ, n, value = struct.unpack(order + "HHI4s",
+                                           entries[i * 12:(i + 1) * 12])
+        if tag not in wanted:
+            continue
+        size = TYPE_SIZES.get(typ, 1) * n
+        if size > 4:
+            here = f.tell()
+            f.seek(base + struct.unpack(order + "I", value)[0])
+            value = f.read(size)
+            f.seek(here)
+        if typ == 2:
+            ret[wanted[tag]] = value[:size].split(b"\0")[0].decode("ascii",
+                                                                  "replace")
+        elif typ == 4:
+            ret[wanted[tag]] = struct.unpack(order + "I", value)[0]
+        elif typ == 5:
+            num, den = struct.unpack(order + "II", value[:8])
+            ret[wanted[tag]] = float(num) / den if den else 0.0
+    return ret
+
+
+def readTiff(f, base):
+    "Read the EXIF date tags of the TIFF structure starting at BASE in F"
+    f.seek(base)
+    head = f.read(8)
+    order = {b"II": "<", b"MM": ">"}.get(head[:2])
+    if order is None:
+        return {}
+    ifd0 = struct.unpack(order + "I", head[4:8])[0]
+    ret = readIfd(f, base, ifd0, order, IFD0_TAGS)
+    if "ExifOffset" in ret:
+        ret.update(readIfd(f, base, ret.pop("ExifOffset"), order, EXIF_TAGS))
+    return ret
+
+
+def readJpeg(f):
+    "Find the APP1 Exif segment of a JPEG and read its date tags"
+    f.seek(2)
+    while True:
+        marker = f.read(4)
+        if len(marker) < 4 or marker[0:1] != b"\xff":
+            return {}
+        code = marker[1]
+        length = struct.unpack(">H", marker[2:4])[0]
+        if code == 0xe1:
+            if f.read(6) == b"Exif\0\0":
+                return readTiff(f, f.tell())
+            f.seek(length - 8, 1)
+        elif code == 0xda or code == 0xd9:
+            return {}
+        else:
+            f.seek(length - 2, 1)
+
+
+def readExif(fname):
+    """Return the EXIF date tags of FNAME, reading only the header; {} for
+       files without them
+
+    """
+    try:
+        f = open(fname, "rb")
+    except IOError:
+        return {}
+    try:
+        magic = f.read(4)
+        if magic[:2] == b"\xff\xd8":
+            return readJpeg(f)
+        if magic in (b"II*\0", b"MM\0*"):
+            return readTiff(f, 0)
+    except (struct.error, ValueError):
+        pass
+    finally:
+        f.close()
+    return {}
+
+
+def parseTime(timestr):
+    "Convert an EXIF or ISO date string to seconds since the epoch"
+    try:
+        return time.mktime(time.strptime(timestr, "%Y:%m:%d %H:%M:%S"))
+    except ValueError:
+        return time.mktime(time.strptime(timestr, "%Y-%m-%dT%H:%M:%S"))
+
+
+def fileTime(fname, mtime=None):
+    "Return the EXIF creation time of FNAME if possible, or its mtime"
+    exif = readExif(fname)
+    for tag in ("DateTimeOriginal", "DateTime", "DateTimeDigitized"):
+        if tag in exif:
+            try:
+                return parseTime(exif[tag])
+            except ValueError:
+                pass
+    if mtime is None:
+        mtime = os.path.getmtime(fname)
+    return mtime
+
+
+class SourceIndex(object):
+    """Per-file records for one directory, stored in a sidecar file and valid
+       while the file's size and mtime are unchanged"""
+
+    def __init__(self, dirname):
+        self.fname = os.path.join(dirname, INDEX_NAME)
+        self.entries = {}
+        self.dirty = False
+        try:
+            self.entries = json.loads(open(self.fname, "r").read())
+        except (IOError, ValueError):
+            pass
+
+    def lookup(self, path, st):
+        "Return the record for PATH if still valid for stat result ST"
+        entry = self.entries.get(os.path.basename(path))
+        if (entry is not None and entry["size"] == st.st_size and
+                entry["mtime"] == st.st_mtime):
+            return entry
+        return None
+
+    def update(self, path, st, **fields):
+        "Set FIELDS on the record for PATH, starting afresh if stale"
+        entry = self.lookup(path, st)
+        if entry is None:
+            entry = {"size": st.st_size, "mtime": st.st_mtime}
+            self.entries[os.path.basename(path)] = entry
+        entry.update(fields)
+        self.dirty = True
+
+    def save(self):
+        "Write the sidecar if anything changed; unwritable dirs are skipped"
+        if not self.dirty:
+            return
+        tmp = "%s.%d" % (self.fname, os.getpid())
+        try:
+            out = open(tmp, "w")
+            out.write(json.dumps(self.entries, sort_keys=True))
+            out.close()
+            os.replace(tmp, self.fname)
+            self.dirty = False
+        except (IOError, OSError):
+            pass
+
+
+def openIndexes(fnames):
+    "Return a {dirname: SourceIndex} for the directories of FNAMES"
+    return dict((d, SourceIndex(d))
+                for d in set(os.path.dirname(os.path.abspath(f))
+                             for f in fnames))
+
+
+def scanTimes(fnames, threads=8):
+    """Return the creation time of each of FNAMES, scanning headers in
+       parallel and reusing/refreshing the sidecar index of each directory
+
+    """
+    indexes = openIndexes(fnames)
+    stats = [os.stat(f) for f in fnames]
+    times = [None] * len(fnames)
+    stale = []
+    for (i, f) in enumerate(fnames):
+        index = indexes[os.path.dirname(os.path.abspath(f))]
+        entry = index.lookup(f, stats[i])
+        if entry is not None and "time" in entry:
+            times[i] = entry["time"]
+        else:
+            stale.append(i)
+
+    if stale:
+        pool = ThreadPool(threads)
+        scanned = pool.map(lambda i: fileTime(fnames[i], stats[i].st_mtime),
+                           stale)
+        pool.close()
+        pool.join()
+        for (i, t) in zip(stale, scanned):
+            times[i] = t
+            index = indexes[os.path.dirname(os.path.abspath(fnames[i]))]
+            index.update(fnames[i], stats[i], time=t)
+        for index in indexes.values():
+            index.save()
+    return times
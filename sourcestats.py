@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+#
+# Per-source histogram statistics, computed once per source and settings and
+# kept in the sidecar timestamp index, from which auto-contrast and temporal
+# deflicker are derived for each output frame as a single lookup table
+#
+
+import os
+from multiprocessing.dummy import Pool as ThreadPool
+
+import numpy
+
+from sourceindex import openIndexes
+from pixelengine import mixTable
+
+# Rec. 601 luma weights, for the brightness that deflicker evens out
+LUMA = numpy.array([0.299, 0.587, 0.114])
+
+
+def imageStats(arr):
+    """Return the per-channel darkest and brightest levels present and the
+       mean level of the HxWx3 uint8 array ARR
+
+    """
+    lo, hi, mean = [], [], []
+    for c in range(3):
+        hist = numpy.bincount(arr[..., c].ravel(), minlength=256)
+        nz = numpy.nonzero(hist)[0]
+        lo.append(int(nz[0]))
+        hi.append(int(nz[-1]))
+        mean.append(float(numpy.dot(hist, numpy.arange(256))) / hist.sum())
+    return {"lo": lo, "hi": hi, "mean": mean}
+
+
+def scanStats(sources, threads=8):
+    """Return imageStats() of each InterpImage in SOURCES as loaded, decoding
+       in parallel only those not already in the sidecar index under the
+       source's statsKey()
+
+    """
+    fnames = [s.filename for s in sources]
+    indexes = openIndexes(fnames)
+    stats = [os.stat(f) for f in fnames]
+    ret = [None] * len(sources)
+    stale = []
+    for (i, s) in enumerate(sources):
+        index = indexes[os.path.dirname(os.path.abspath(s.filename))]
+        entry = index.lookup(s.filename, stats[i])
+        if entry is not None and s.statsKey() in entry.get("stats", {}):
+            ret[i] = entry["stats"][s.statsKey()]
+        else:
+            stale.append(i)
+
+    if stale:
+        pool = ThreadPool(threads)
+        scanned = pool.map(lambda i: imageStats(sources[i].statsPixels()),
+                           stale)
+        pool.close()
+        pool.join()
+        for (i, st) in zip(stale, scanned):
+            ret[i] = st
+            s = sources[i]
+            index = indexes[os.path.dirname(os.path.abspath(s.filename))]
+            entry = index.lookup(s.filename, stats[i]) or {}
+            known = dict(entry.get("stats", {}))
+            known[s.statsKey()] = st
+            index.update(s.filename, stats[i], stats=known)
+        for index in indexes.values():
+            index.save()
+    return ret
+
+
+def deflickerGains(stats, window):
+    """Return for each source the gain bringing its mean brightness to the
+       average over the WINDOW sources centred on it; 1.0 throughout if
+       WINDOW is below 2
+
+    """
+    n = len(stats)
+    if window < 2 or n == 0:
+        return [1.0] * n
+    luma = numpy.array([numpy.dot(LUMA, s["mean"]) for s in stats])
+    half = window // 2
+    gains = []
+    for i in range(n):
+        target = luma[max(0, i - half):min(n, i + half + 1)].mean()
+        gains.append(float(target / luma[i]) if luma[i] > 0 else 1.0)
+    return gains
+
+
+def levelsTable(s1, s2, r, ac=0.0, g1=1.0, g2=1.0):
+    """Return the (3,256) table applying deflicker gain and auto-contrast AC
+       to a blend by R of sources with stats S1, S2 and gains G1, G2, from
+       their statistics interpolated by R; None if it is the identity
+
+    """
+    gain = (1 - r) * g1 + r * g2
+    if ac == 0.0 and abs(gain - 1.0) < 1e-4:
+        return None
+    ramp = numpy.arange(256, dtype=numpy.float64)
+    gained = numpy.clip(ramp * gain, 0, 255).astype(numpy.int64)
+    table = numpy.empty((3, 256), dtype=numpy.int64)
+    for c in range(3):
+        t = gained
+        if ac != 0.0:
+            lo = min(((1 - r) * s1["lo"][c] + r * s2["lo"][c]) * gain, 255.0)
+            hi = min(((1 - r) * s1["hi"][c] + r * s2["hi"][c]) * gain, 255.0)
+            if hi > lo:
+                stretched = numpy.clip(((ramp - lo) * 255.0 / (hi - lo))
+                                       .astype(numpy.int64), 0, 255)
+                t = mixTable(stretched, ac)[gained]
+        table[c] = t
+    return table.astype(numpy.uint8)
@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+
+#
+# Image-stacking engine behind stack.py and stack-32bit.py: sources are
+# decoded in parallel and folded into a single floating-point accumulator,
+# then written out as 8-bit or 16-bit PNG/TIFF. Median, percentile and
+# sigma-clipped stacks, which need every frame's value of a pixel at once,
+# go through a banded tile store on disk instead
+#
+
+import argparse
+import math
+import multiprocessing
+import os
+import struct
+import tempfile
+import threading
+import zlib
+from multiprocessing.dummy import Pool
+
+import numpy
+from PIL import Image
+
+from budget import parseBytes
+from tonelut import *
+
+MODES = ("mean", "sum", "max", "min", "weighted")
+TILED_MODES = ("median", "percentile", "sigmaclip")
+
+# Bytes of working memory per stored sample while reducing a band: the uint8
+# sample, a float32 copy, its squared deviation and two keep masks
+WORK_BYTES = 12
+
+# Bytes of working memory per value of a reduced band, whatever the number of
+# frames: per-pixel counts, means and variances, and the band itself
+PIXEL_BYTES = 64
+
+# Lighten and darken are the usual names for max and min (star trails)
+ALIASES = {"lighten": "max", "darken": "min", "average": "mean"}
+
+# EXIF tags used to weight a frame by the light it gathered
+EXIF_IFD = 0x8769
+EXPOSURE_TIME = 33434
+F_NUMBER = 33437
+ISO_SPEED = 34855
+
+
+def exposureWeight(img):
+    """Return the relative exposure of IMG, exposure time x ISO / f-number^2,
+       from its EXIF; 1.0 if that is missing
+
+    """
+    try:
+        exif = img.getexif().get_ifd(EXIF_IFD)
+        weight = float(exif[EXPOSURE_TIME])
+    except (AttributeError, KeyError, TypeError, ValueError,
+            ZeroDivisionError):
+        return 1.0
+    try:
+        weight *= float(exif[ISO_SPEED]) / 100.0
+    except (KeyError, TypeError, ValueError):
+        pass
+    try:
+        weight /= float(exif[F_NUMBER]) ** 2
+    except (KeyError, TypeError, ValueError, ZeroDivisionError):
+        pass
+    return weight if weight > 0 else 1.0
+
+
+class Stack(object):
+    """Running stack of HxWx3 uint8 frames in a float accumulator, split into
+       horizontal bands each with its own lock, so that several threads can
+       add frames at once without each holding a private accumulator"""
+
+    def __init__(self, mode="mean", dtype=numpy.float32, bands=64):
+        mode = ALIASES.get(mode, mode)
+        if mode not in MODES:
+            raise ValueError("Unknown stacking mode: %s" % mode)
+        self.mode = mode
+        self.dtype = dtype
+        self.nbands = bands
+        self.acc = None
+        self.bands = None
+        self.count = 0
+        self.weight = 0.0
+        self.lock = threading.Lock()
+
+    def start(self, shape):
+        "Allocate the accumulator for frames of SHAPE; lock held"
+        fill = {"max": -numpy.inf, "min": numpy.inf}.get(self.mode, 0)
+        self.acc = numpy.full(shape, fill, dtype=self.dtype)
+        rows = int(math.ceil(float(shape[0]) / self.nbands))
+        self.bands = [(threading.Lock(), slice(y, y + rows))
+                      for y in range(0, shape[0], rows)]
+
+    def add(self, arr, weight=1.0):
+        "Fold frame ARR into the stack, weighted by WEIGHT in weighted mode"
+        with self.lock:
+            if self.acc is None:
+                self.start(arr.shape)
+            elif arr.shape != self.acc.shape:
+                raise ValueError("Frame is %dx%d; the stack is %dx%d" %
+                                 (arr.shape[1], arr.shape[0],
+                                  self.acc.shape[1], self.acc.shape[0]))
+            self.count += 1
+            self.weight += weight
+        for (lock, rows) in self.bands:
+            src = arr[rows]
+            if self.mode == "weighted":
+                src = numpy.multiply(src, weight, dtype=self.dtype)
+            with lock:
+                dst = self.acc[rows]
+                if self.mode == "max":
+                    numpy.maximum(dst, src, out=dst)
+                elif self.mode == "min":
+                    numpy.minimum(dst, src, out=dst)
+                else:
+                    numpy.add(dst, src, out=dst)
+
+    def result(self):
+        "Return the stacked image as floats on the 0-255 scale"
+        if self.acc is None:
+            raise ValueError("No frames stacked")
+        if self.mode == "mean":
+            return self.acc / self.count
+        if self.mode == "weighted":
+            return self.acc / self.weight
+        return self.acc.copy()
+
+
+def loadFrame(fname, curves=None, weigh=False):
+    """Decode FNAME to an HxWx3 uint8 array with CURVES applied, and its
+       exposure weight if WEIGH
+
+    """
+    img = Image.open(fname)
+    weight = exposureWeight(img) if weigh else 1.0
+    img = imageTone(img.convert("RGB"), IDENTITY, curves)
+    return numpy.asarray(img), weight
+
+
+def stackFiles(fnames, mode="mean", curves=None, threads=None,
+               dtype=numpy.float32):
+    """Stack the images FNAMES, decoding and accumulating on THREADS threads
+       (default one per core); returns the Stack
+
+    """
+    stack = Stack(mode, dtype)
+    lock = threading.Lock()
+    done = [0]
+
+    def add(fname):
+        arr, weight = loadFrame(fname, curves, stack.mode == "weighted")
+        stack.add(arr, weight)
+        with lock:
+            done[0] += 1
+            print("Read in image [%04d] [%s]" % (done[0], fname))
+
+    pool = Pool(threads or multiprocessing.cpu_count())
+    try:
+        for r in pool.imap_unordered(add, fnames):
+            pass
+    finally:
+        pool.close()
+        pool.join()
+    return stack
+
+
+def sigmaClip(x, kappa=2.5, iterations=5):
+    """Return the mean over axis 0 of X after repeatedly rejecting values more
+       than KAPPA standard deviations from the mean of those remaining
+
+    """
+    x = x.astype(numpy.float32)
+    keep = numpy.ones(x.shape, dtype=bool)
+    clipped = numpy.empty(x.shape, dtype=bool)
+    dev = numpy.empty(x.shape, dtype=numpy.float32)
+    for i in range(iterations):
+        count = keep.sum(axis=0)
+        mean = x.sum(axis=0, where=keep) / count
+        # squared deviations, compared with kappa squared times the variance
+        numpy.subtract(x, mean, out=dev)
+        numpy.square(dev, out=dev)
+        var = dev.sum(axis=0, where=keep) / count
+        numpy.less_equal(dev, kappa * kappa * var, out=clipped)
+        clipped &= keep
+        if numpy.array_equal(clipped, keep):
+            break
+        keep, clipped = clipped, keep
+    return x.sum(axis=0, where=keep) / keep.sum(axis=0)
+
+
+class TileStore(object):
+    """Frames cut into horizontal bands and written band-major to a file, so
+       that one band of every frame maps back as a single contiguous
+       (frames, rows, width, 3) block"""
+
+    def __init__(self, fname, nframes, shape, bandrows):
+        self.fname = fname
+        self.nframes = nframes
+        self.shape = shape
+        self.bandrows = bandrows
+        self.nbands = int(math.ceil(float(shape[0]) / bandrows))
+        self.slot = bandrows * shape[1] * 3
+        self.fd = os.open(fname, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.ftruncate(self.fd, self.nbands * nframes * self.slot)
+
+    def rows(self, b):
+        return slice(b * self.bandrows,
+                     min((b + 1) * self.bandrows, self.shape[0]))
+
+    def write(self, i, arr):
+        "Store frame number I, an HxWx3 uint8 array, with plain writes"
+        if arr.shape != self.shape:
+            raise ValueError("Frame is %dx%d; the stack is %dx%d" %
+                             (arr.shape[1], arr.shape[0],
+                              self.shape[1], self.shape[0]))
+        for b in range(self.nbands):
+            os.pwrite(self.fd, numpy.ascontiguousarray(arr[self.rows(b)]),
+                      (b * self.nframes + i) * self.slot)
+
+    def band(self, b):
+        "Map band B of every frame read-only"
+        rows = self.rows(b)
+        block = numpy.memmap(self.fname, numpy.uint8, "r",
+                             b * self.nframes * self.slot,
+                             (self.nframes, self.bandrows, self.shape[1], 3))
+        return block[:, :rows.stop - rows.start]
+
+    def close(self):
+        os.close(self.fd)
+        os.remove(self.fname)
+
+
+def reduceBand(block, mode, percentile=50.0, kappa=2.5, iterations=5):
+    "Reduce the (frames, rows, width, 3) BLOCK over its frames by MODE"
+    if mode == "median":
+        return numpy.median(block, axis=0)
+    if mode == "percentile":
+        return numpy.percentile(block, percentile, axis=0)
+    return sigmaClip(block, kappa, iterations)
+
+
+def stackTiled(fnames, mode="median", curves=None, threads=None,
+               budget=1 << 30, tmpdir=None, percentile=50.0, kappa=2.5,
+               iterations=5):
+    """Stack FNAMES by a per-pixel median, percentile or sigma-clipped mean:
+       frames are streamed into a tile store on disk, then reduced band by
+       band on THREADS threads, keeping working memory within BUDGET bytes;
+       returns the stacked image as floats on the 0-255 scale
+
+    """
+    threads = threads or multiprocessing.cpu_count()
+    w, h = Image.open(fnames[0]).size
+    n = len(fnames)
+    # the result is held throughout; then each thread needs a decoded frame
+    # while tiling, and a band of rows while reducing
+    avail = budget - h * w * 3 * 8
+    decode = h * w * 3
+    rowcost = w * 3 * (n * WORK_BYTES + PIXEL_BYTES)
+    if avail < max(decode, rowcost):
+        raise ValueError("A memory budget of %d bytes is too small to stack "
+                         "%d frames of %dx%d" % (budget, n, w, h))
+    threads = int(max(1, min(threads, avail // max(decode, rowcost))))
+    bandrows = int(max(1, min(h, avail // (threads * rowcost))))
+
+    fd, fname = tempfile.mkstemp(".tiles", "stack-", tmpdir)
+    os.close(fd)
+    store = TileStore(fname, n, (h, w, 3), bandrows)
+    lock = threading.Lock()
+    done = [0]
+
+    def add(item):
+        i, f = item
+        store.write(i, loadFrame(f, curves)[0])
+        with lock:
+            done[0] += 1
+            print("Read in image [%04d] [%s]" % (done[0], f))
+
+    def reduce(b):
+        result[store.rows(b)] = reduceBand(store.band(b), mode, percentile,
+                                           kappa, iterations)
+
+    result = numpy.zeros((h, w, 3), dtype=numpy.float64)
+    pool = Pool(threads)
+    try:
+        print("Tiling %d frames into %d bands of %d rows in %s" %
+              (n, store.nbands, bandrows, fname))
+        for r in pool.imap_unordered(add, enumerate(fnames)):
+            pass
+        for r in pool.imap_unordered(reduce, range(store.nbands)):
+            pass
+    finally:
+        pool.close()
+        pool.join()
+        store.close()
+    return result
+
+
+def to16(arr):
+    "Scale a 0-255 float image to 0-65535 uint16, clipping"
+    return numpy.clip(arr * 257.0 + 0.5, 0, 65535).astype(numpy.uint16)
+
+
+def to8(arr):
+    "Round a 0-255 float image to uint8, clipping"
+    return numpy.clip(arr + 0.5, 0, 255).astype(numpy.uint8)
+
+
+def pngChunk(kind, data):
+    return (struct.pack(">I", len(data)) + kind + data +
+            struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+
+
+def writePNG16(fname, arr, level=6):
+    "Write the HxWx3 uint16 array ARR as a 16-bit RGB PNG"
+    h, w = arr.shape[:2]
+    rows = numpy.zeros((h, 1 + w * 6), dtype=numpy.uint8)
+    rows[:, 1:] = arr.astype(">u2").view(numpy.uint8).reshape(h, w * 6)
+    out = open(fname, "wb")
+    out.write(b"\x89PNG\r\n\x1a\n")
+    out.write(pngChunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 16, 2, 0, 0, 0)))
+    out.write(pngChunk(b"IDAT", zlib.compress(rows.tobytes(), level)))
+    out.write(pngChunk(b"IEND", b""))
+    out.close()
+
+
+def writeTIFF16(fname, arr):
+    "Write the HxWx3 uint16 array ARR as an uncompressed 16-bit RGB TIFF"
+    h, w = arr.shape[:2]
+    data = arr.astype("<u2").tobytes()
+    ntags = 10
+    bpsoffset = 8 + 2 + ntags * 12 + 4
+    dataoffset = bpsoffset + 6
+    tags = [
+        (256, 4, 1, w),                 # ImageWidth
+        (257, 4, 1, h),                 # ImageLength
+        (258, 3, 3, bpsoffset),         # BitsPerSample
+        (259, 3, 1, 1),                 # Compression: none
+        (262, 3, 1, 2),                 # PhotometricInterpretation: RGB
+        (273, 4, 1, dataoffset),        # StripOffsets
+        (277, 3, 1, 3),                 # SamplesPerPixel
+        (278, 4, 1, h),                 # RowsPerStrip
+        (279, 4, 1, len(data)),         # StripByteCounts
+        (284, 3, 1, 1),                 # PlanarConfiguration: chunky
+    ]
+    out = open(fname, "wb")
+    out.write(b"II*\x00" + struct.pack("<I", 8))
+    out.write(struct.pack("<H", ntags))
+    for (tag, kind, count, value) in tags:
+        if kind == 3 and count == 1:
+            out.write(struct.pack("<HHIHH", tag, kind, count, value, 0))
+        else:
+            out.write(struct.pack("<HHII", tag, kind, count, value))
+    out.write(struct.pack("<I", 0))
+    out.write(struct.pack("<HHH", 16, 16, 16))
+    out.write(data)
+    out.close()
+
+
+def writeImage(fname, arr, depth=8):
+    """Write the 0-255 float image ARR to FNAME; 16-bit for DEPTH 16 or a TIFF,
+       otherwise 8-bit in whatever format PIL picks from the extension
+
+    """
+    ext = fname.rsplit(".", 1)[-1].lower()
+    if ext in ("tif", "tiff"):
+        writeTIFF16(fname, to16(arr))
+    elif depth == 16:
+        if ext != "png":
+            raise ValueError("16-bit output needs a .png or .tif file: %s" %
+                             fname)
+        writePNG16(fname, to16(arr))
+    else:
+        Image.fromarray(to8(arr)).save(fname)
+
+
+def readCurves(fname="adjustment.json"):
+    "Return the curves from FNAME, or None if it cannot be read"
+    try:
+        curves = loadCurves(fname)
+        print("Loaded curve adjustment layer")
+        return curves
+    except (IOError, ValueError, KeyError):
+        print("Some problem reading %s" % fname)
+        return None
+
+
+def main(output="out.png", depth=8):
+    "Command-line entry point; OUTPUT and DEPTH are the script's defaults"
+    parser = argparse.ArgumentParser(description="Stack images")
+    parser.add_argument("files", nargs="+", help="images to stack")
+    parser.add_argument("--mode", default="mean",
+                        choices=MODES + TILED_MODES + tuple(ALIASES),
+                        help="how to combine pixels: mean, sum, max/lighten "
+                        "(star trails), min/darken, exposure-weighted mean, "
+                        "or median, percentile and sigmaclip to reject "
+                        "passing objects")
+    parser.add_argument("--output", "-o", default=output,
+                        help="output image (.png or .tif)")
+    parser.add_argument("--depth", type=int, choices=(8, 16), default=depth,
+                        help="output bits per channel (TIFF is always 16)")
+    parser.add_argument("--threads", type=int,
+                        help="decoding threads (default: one per core)")
+    parser.add_argument("--double", action="store_true",
+                        help="accumulate in float64 rather than float32")
+    parser.add_argument("--curves", default="adjustment.json",
+                        help="tone curve file from gen-curve.py")
+    parser.add_argument("--memory", type=parseBytes, default=1 << 30,
+                        help="working memory budget for the median, "
+                        "percentile and sigmaclip modes, e.g. 4G")
+    parser.add_argument("--tmpdir",
+                        help="directory for the tile store of those modes")
+    parser.add_argument("--percentile", type=float, default=50.0,
+                        help="percentile taken by --mode percentile")
+    parser.add_argument("--kappa", type=float, default=2.5,
+                        help="rejection threshold of --mode sigmaclip, in "
+                        "standard deviations")
+    parser.add_argument("--iterations", type=int, default=5,
+                        help="maximum rejection passes of --mode sigmaclip")
+    args = parser.parse_args()
+
+    curves = readCurves(args.curves)
+    if args.mode in TILED_MODES:
+        result = stackTiled(args.files, args.mode, curves, args.threads,
+                            args.memory, args.tmpdir, args.percentile,
+                            args.kappa, args.iterations)
+    else:
+        result = stackFiles(args.files, args.mode, curves, args.threads,
+                            numpy.float64 if args.double else
+                            numpy.float32).result()
+    writeImage(args.output, result, args.depth)
+    print("Written %s" % args.output)
+
+if __name__ == "__main__":
+    main()
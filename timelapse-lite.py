@@ -2,26 +2,20 @@
 
 from PIL import Image
 import sys
-import os
 import glob
 import time
+import threading
+import queue
+from itertools import groupby
 from os.path import getmtime
-from PIL import Image, ImageOps, ImageChops, ImageFilter
 from PIL.Image import blend as imageBlend
-from multiprocessing.dummy import Pool as ThreadPool
+from sinks import ImageSequenceSink, openSink, parseOptions
 
 
 def tlog(s):
     "Output info log message S"
     print("%s: %s" % (time.asctime(), s))
 
-def pMap(fn, arr, threads=2):
-    pool = ThreadPool(threads)
-    results = pool.map(fn, arr)
-    pool.close()
-    pool.join()
-    return results
-
 
 def findFiles(indir):
     "return sorted list of input files and mtimes"
@@ -31,52 +25,267 @@ def findFiles(indir):
     return filedata
 
 
-def filebefore(filedata, ts):
-    "return last filename before ts"
-    return [ (fts,fname) for (fts,fname) in filedata if fts<=ts ][-1]
-
-def fileafter(filedata, ts):
-    "return first filename after ts"
-    return [ (fts,fname) for (fts,fname) in filedata if fts>=ts ][0]
-
-def tsproportion(filedata, ts):
-    "return proportion ts falls between two image timestamps"
-    leftimg=filebefore(filedata, ts)[0]
-    rightimg=fileafter(filedata, ts)[0]
-    if(leftimg==rightimg):
-        prop=0
-    else:
-        prop=(ts-leftimg)/(rightimg-leftimg)
-    return prop
+def itertasks(filedata, noframes):
+    "generate interpolation tasks in frame order, in one pass over file data"
+    mints, maxts=(filedata[0][0], filedata[-1][0])
+    before=after=0
+    for i in range(noframes):
+        ts=mints+(maxts-mints)*i/noframes
+        while before+1<len(filedata) and filedata[before+1][0]<=ts:
+            before+=1
+        while filedata[after][0]<ts:
+            after+=1
+        (leftts, f1), (rightts, f2)=filedata[before], filedata[after]
+        if leftts==rightts:
+            prop=0
+        else:
+            prop=(ts-leftts)/(rightts-leftts)
+        yield (f1, f2, prop, i)
 
 def mktasks(filedata, noframes):
     "convert file data to list of interpolation tasks"
-    mints, maxts=(filedata[0][0], filedata[-1][0])
-    timestamps=[ mints+(maxts-mints)*i/noframes for i in range(noframes) ]
-    filebefores=[ filebefore(filedata, ts)[1] for ts in timestamps ]
-    fileafters=[ fileafter(filedata, ts)[1] for ts in timestamps ]
-    tasks=[ tsproportion(filedata, ts) for ts in timestamps ]
-    return list(zip(filebefores, fileafters, tasks, range(noframes)))
+    return list(itertasks(filedata, noframes))
+
+
+def pairTasks(tasks):
+    "group consecutive tasks blending the same pair of files, lazily"
+    return ( (pair, list(group)) for (pair, group) in
+             groupby(tasks, key=lambda t: (t[0], t[1])) )
+
+
+class PairWindow(object):
+    """Decoded images shared between pair groups: each file is decoded once
+       and released when the last reference to it is dropped"""
+
+    def __init__(self):
+        self.uses={}
+        self.images={}
+        self.loading={}
+        self.lock=threading.Lock()
+        self.decodes=0
+
+    def retain(self, fname):
+        "add a use of fname, keeping it once decoded"
+        with self.lock:
+            self.uses[fname]=self.uses.get(fname, 0)+1
+
+    def acquire(self, fname):
+        "return decoded image for fname, decoding it on first use"
+        with self.lock:
+            pending=self.loading.get(fname)
+            if pending is None:
+                pending=self.loading[fname]=threading.Lock()
+        with pending:
+            if fname not in self.images:
+                self.images[fname]=Image.open(fname).convert("RGB")
+                with self.lock:
+                    self.decodes+=1
+            return self.images[fname]
+
+    def release(self, fname):
+        "drop one use of fname, freeing it after the last"
+        with self.lock:
+            self.uses[fname]-=1
+            if self.uses[fname]==0:
+                del self.uses[fname]
+                self.images.pop(fname, None)
+                self.loading.pop(fname, None)
+
+
+def dispatchPairs(pairs, window):
+    """number pair groups in order, retaining their files in window; the
+       files of the latest pair stay held until a later pair drops them, so
+       a file shared by neighbouring pairs is decoded only once"""
+    held=set()
+    for (seq, (pair, group)) in enumerate(pairs):
+        files=set(pair)
+        for f in files:
+            window.retain(f)
+        for f in files-held:
+            window.retain(f)
+        for f in held-files:
+            window.release(f)
+        held=files
+        yield (seq, pair, group)
+    for f in held:
+        window.release(f)
+
+
+STOP=None
+
+class Stage(object):
+    """pool of worker threads applying fn to items from a bounded queue and
+       handing each result to emit, timing the work itself so that the stage's
+       utilization excludes waiting on its neighbours"""
 
+    def __init__(self, name, fn, workers, emit=None, onerror=None):
+        self.name=name
+        self.fn=fn
+        self.emit=emit
+        self.onerror=onerror
+        self.queue=queue.Queue(2*workers)
+        self.busy=0.0
+        self.items=0
+        self.errors=[]
+        self.lock=threading.Lock()
+        self.started=time.time()
+        self.elapsed=None
+        self.threads=[ threading.Thread(target=self.run) for i in range(workers) ]
+        for t in self.threads:
+            t.daemon=True
+            t.start()
 
-def interpolateImage(task, outdir):
+    def put(self, item):
+        self.queue.put(item)
+
+    def run(self):
+        while True:
+            item=self.queue.get()
+            if item is STOP:
+                self.queue.put(STOP)
+                return
+            start=time.time()
+            error=None
+            try:
+                out=self.fn(item)
+            except Exception as e:
+                error=e
+                tlog("%s failed: %s" % (self.name, e))
+            with self.lock:
+                self.busy+=time.time()-start
+                self.items+=1
+                if error is not None:
+                    self.errors.append(error)
+            if error is not None:
+                if self.onerror is not None:
+                    self.onerror(item)
+            elif self.emit is not None:
+                self.emit(item, out)
+
+    def close(self):
+        "wait until every queued item has been processed"
+        self.queue.put(STOP)
+        for t in self.threads:
+            t.join()
+        self.elapsed=time.time()-self.started
+
+    def utilization(self):
+        "fraction of the stage's worker time spent working"
+        return self.busy/max(len(self.threads)*self.elapsed, 1e-6)
+
+    def __str__(self):
+        return "%s: %d workers, %d items, %.0f%% busy" % (
+            self.name, len(self.threads), self.items, 100*self.utilization())
+
+
+class Sequencer(object):
+    "pass items to fn in sequence order, whatever order they arrive in"
+
+    def __init__(self, fn):
+        self.fn=fn
+        self.next=0
+        self.pending={}
+        self.lock=threading.Lock()
+
+    def put(self, seq, item):
+        with self.lock:
+            self.pending[seq]=item
+            while self.next in self.pending:
+                self.fn(self.pending.pop(self.next))
+                self.next+=1
+
+
+def parseWorkers(spec):
+    "return (readers, blenders, encoders) from 'N' or 'R,B,E'"
+    counts=[ int(n) for n in str(spec).split(",") ]
+    if len(counts)==1:
+        counts*=3
+    if len(counts)!=3 or min(counts)<1:
+        raise ValueError("worker counts must be N or R,B,E: %s" % spec)
+    return tuple(counts)
+
+def streamWindow(workers):
+    "frames a stream sink must hold to never block with this many in flight"
+    (readers, blenders, encoders)=workers
+    return max(32, 3*(blenders+encoders)+1)
+
+def openOutput(outdir, window=32, options=None):
+    """return sink for outdir: a directory of JPEGs saved with PIL options, or
+       a stream (-, *.y4m, |cmd)"""
+    if outdir=="-" or outdir.endswith(".y4m") or outdir.startswith("|"):
+        return openSink(outdir, None, window=window)
+    return ImageSequenceSink(outdir+"/img-%05d.jpg", options)
+
+def interpolateImage(task, img1=None, img2=None):
     "implement task - interpolate between two images"
     f1,f2,alpha,counter=task
     tlog("Image %d: files=[%s],[%s] prop=%f" % ( counter,f1,f2,alpha))
-    img1=Image.open(f1).convert("RGB")
-    img2=Image.open(f2).convert("RGB")
-    img=imageBlend(img1, img2, alpha).convert("RGB")
-    outfname=outdir+"/img-%05d.jpg" % (counter)
-    img.save(outfname)
+    if img1 is None:
+        img1=Image.open(f1).convert("RGB")
+    if img2 is None:
+        img2=Image.open(f2).convert("RGB")
+    return imageBlend(img1, img2, alpha).convert("RGB")
+
+def interpolateImages(tasks, sink, workers=(2, 2, 2)):
+    """main loop - run tasks through reader, blend and encoder stages, each
+       with its own worker count, writing frames to sink"""
+    (readers, blenders, encoders)=workers
+    window=PairWindow()
+    frames=[0]
+    lock=threading.Lock()
 
-def interpolateImages(tasks, outdir, threads=2):
-    "main loop - run a list of tasks"
-    pMap(lambda t: interpolateImage(t, outdir), tasks, threads)
+    def read(item):
+        (seq, (f1, f2), group)=item
+        return (window.acquire(f1), window.acquire(f2))
+
+    def release(pairitem):
+        (pair, group, imgs)=pairitem
+        for task in group:
+            if imgs is None:
+                sink.skip(task[3])
+            else:
+                blend.put((task,)+imgs)
+        window.release(pair[0])
+        if pair[1]!=pair[0]:
+            window.release(pair[1])
+
+    def encode(item):
+        sink.write(*item)
+        with lock:
+            frames[0]+=1
+
+    sequencer=Sequencer(release)
+    encoder=Stage("encode", encode, encoders,
+                  onerror=lambda item: sink.skip(item[0]))
+    blend=Stage("blend", lambda item: interpolateImage(*item), blenders,
+                emit=lambda item, img: encoder.put((item[0][3], img)),
+                onerror=lambda item: sink.skip(item[0][3]))
+    reader=Stage("read", read, readers,
+                 emit=lambda item, imgs: sequencer.put(item[0], item[1:]+(imgs,)),
+                 onerror=lambda item: sequencer.put(item[0], item[1:]+(None,)))
+    npairs=0
+    for item in dispatchPairs(pairTasks(tasks), window):
+        reader.put(item)
+        npairs+=1
+    stages=(reader, blend, encoder)
+    for stage in stages:
+        stage.close()
+    sink.close()
+    tlog("Rendered %d frames from %d pairs with %d decodes" %
+         (frames[0], npairs, window.decodes))
+    tlog("Output: %s, %.1fs encoding" % (sink, sink.encodetime))
+    for stage in stages:
+        tlog("Stage %s" % stage)
+    tlog("Busiest stage: %s" % max(stages, key=Stage.utilization).name)
+    errors=sum(len(stage.errors) for stage in stages)
+    if errors:
+        raise RuntimeError("%d pipeline items failed; first: %s" %
+                           (errors, [ e for stage in stages
+                                      for e in stage.errors ][0]))
 
 
 def main():
-    (noframes, indir, outdir, threads) = [1500, "jpeg-in", "jpeg-out", 2]
-    tlog("Parameters")
+    (noframes, indir, outdir, workers, options) = [1500, "jpeg-in", "jpeg-out", (2, 2, 2), {}]
     if len(sys.argv) > 1:
         noframes = int(sys.argv[1])
     if len(sys.argv) > 2:
@@ -84,16 +293,18 @@ def main():
     if len(sys.argv) > 3:
         outdir = sys.argv[3]
     if len(sys.argv) > 4:
-        threads = int(sys.argv[4])
+        workers = parseWorkers(sys.argv[4])
+    if len(sys.argv) > 5:
+        options = parseOptions(sys.argv[5])
+    sink=openOutput(outdir, streamWindow(workers), options)
+    tlog("Parameters: %d frames, %s -> %s, %d readers, %d blenders, "
+         "%d encoders" % ((noframes, indir, outdir)+workers))
 
     tlog("Finding files")
     filedata=findFiles(indir)
 
-    tlog("Building task-list")
-    tasks=mktasks(filedata, noframes)
-
     tlog("Running")
-    interpolateImages(tasks, outdir, threads)
+    interpolateImages(itertasks(filedata, noframes), sink, workers)
 
 if __name__ == "__main__":
     main()
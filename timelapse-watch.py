@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+#
+# Watch the input directory of a running capture and keep the output up to
+# date: new sources are indexed and only the frames they affect are rendered,
+# with the timeline and its caches kept warm from one poll to the next
+#
+# Usage:
+#
+#   ./timelapse-watch.py my_movie.json in/ --poll 60
+#
+
+import argparse
+import importlib
+import os
+import time
+
+from timeline import *
+
+findFiles = importlib.import_module("timelapse-lite").findFiles
+
+# Extensions of files taken to be new sources
+SOURCE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".tif", ".tiff")
+
+
+def newFiles(indir, known, settle):
+    """Return the source files in INDIR not in KNOWN, oldest first, leaving
+       those modified in the last SETTLE seconds or not completely written
+       until the next poll
+
+    """
+    now = time.time()
+    return [f for (t, f) in findFiles(indir)
+            if os.path.abspath(f) not in known and
+            f.lower().endswith(SOURCE_EXTENSIONS) and
+            now - t >= settle and frameComplete(f)]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Render a timelapse as its sources arrive")
+    parser.add_argument("conffile", help="JSON timeline configuration")
+    parser.add_argument("indir", help="directory the camera writes to")
+    parser.add_argument("--poll", type=float, default=60, metavar="SECONDS",
+                        help="time between looks at the input directory")
+    parser.add_argument("--interval", type=float, metavar="SECONDS",
+                        help="source time between output frames; by default "
+                        "`frameinterval' from the config, else the spacing "
+                        "`noframes' gives over the configured sources")
+    parser.add_argument("--settle", type=float, default=5, metavar="SECONDS",
+                        help="leave files modified more recently than this "
+                        "for the next poll, as still being written")
+    parser.add_argument("--once", action="store_true",
+                        help="take in what is there, render and exit")
+    args = parser.parse_args()
+
+    tl = Timeline(args.conffile)
+    if tl.sinkspec:
+        parser.error("watch mode renders image sequences only")
+    if tl.renderer == "processes":
+        # worker processes would read the sources from the config alone
+        print("Rendering with threads: worker processes cannot see new "
+              "sources")
+        tl.renderer = None
+    tl.incremental = True
+    if args.interval:
+        tl.setFrameInterval(args.interval)
+    elif tl.frameinterval is None:
+        tl.setFrameInterval((tl.maxTime() - tl.minTime()) / tl.noframes)
+    print("Watching %s: one frame per %.1fs of capture" %
+          (args.indir, tl.frameinterval))
+
+    known = set(os.path.abspath(i.filename) for i in tl.filelist)
+    fnames = newFiles(args.indir, known, args.settle)
+    while True:
+        if fnames:
+            tl.since = tl.addSources(fnames)
+            known.update(os.path.abspath(f) for f in fnames)
+            print("%s: %d new sources, %d in all; rendering from frame %d of "
+                  "%d" % (time.asctime(), len(fnames), len(tl.filelist),
+                          tl.since, tl.noframes))
+        if fnames or tl.since is None:
+            tl.render()
+            # every frame is now up to date; an empty poll has nothing to do
+            tl.since = tl.noframes
+        if args.once:
+            return
+        time.sleep(args.poll)
+        fnames = newFiles(args.indir, known, args.settle)
+
+if __name__ == "__main__":
+    main()
@@ -2,16 +2,73 @@
 
 from interpimage import *
 from timeline import *
+import argparse
 import sys
 
 
 def main():
-    conffile = "test-config.json"
-    if len(sys.argv) > 1:
-        conffile = sys.argv[1]
-    tl = Timeline(conffile)
+    parser = argparse.ArgumentParser(
+        description="Linear image interpolation for timelapse video")
+    parser.add_argument("conffile", nargs="?", default="test-config.json",
+                        help="JSON timeline configuration")
+    parser.add_argument("--plan", metavar="FILE",
+                        help="dry-run: write the compiled per-frame render "
+                        "plan to FILE (.json or .npz) and exit")
+    parser.add_argument("--preview", type=int, choices=(1, 2, 4, 8),
+                        help="render at 1/N resolution into a preview-N "
+                        "subdirectory of the output directory")
+    parser.add_argument("--every", type=int, metavar="N",
+                        help="render only every Nth frame")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="write per-frame stage timings to FILE: Chrome "
+                        "trace events if it ends .json, else JSON lines")
+    parser.add_argument("--force", action="store_true",
+                        help="re-render every frame, even those the manifest "
+                        "shows to be up to date")
+    parser.add_argument("--shard", metavar="I/N",
+                        help="render only the Ith of N equal, contiguous "
+                        "ranges of frames, for one of several machines "
+                        "sharing the output directory")
+    parser.add_argument("--frames", metavar="A:B",
+                        help="render only frames A to B-1, as a shard")
+    parser.add_argument("--verify", action="store_true",
+                        help="check that every frame is rendered, complete "
+                        "and from the current config, and exit")
+    parser.add_argument("--merge", action="store_true",
+                        help="verify, then fold the shard manifests into the "
+                        "main manifest")
+    args = parser.parse_args()
+    if args.shard and args.frames:
+        parser.error("--shard and --frames are exclusive")
+
+    tl = Timeline(args.conffile, args.preview, args.every, args.trace)
+    if args.verify or args.merge:
+        problems = verifyShards(tl)
+        for p in problems:
+            print(p)
+        if problems:
+            sys.exit(1)
+        print("All %d frames present and up to date" % tl.noframes)
+        if args.merge:
+            print("Merged %d shards into %s" %
+                  (mergeShards(tl), os.path.join(tl.outdir, MANIFEST_NAME)))
+        return
+    try:
+        if args.shard:
+            tl.framerange = parseShard(args.shard, tl.noframes)
+        elif args.frames:
+            tl.framerange = parseFrames(args.frames, tl.noframes)
+    except ValueError as e:
+        parser.error(str(e))
+    if tl.sinkspec == "-":
+        stdoutStream()
     print("Timeline config:\n" + str(tl))
-    tl.render()
+    if args.plan:
+        tl.plan().save(args.plan)
+        print("Written render plan for %d frames to %s" %
+              (tl.noframes, args.plan))
+        return
+    tl.render(force=args.force)
 
 if __name__ == "__main__":
     main()
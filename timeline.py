@@ -4,17 +4,43 @@
 # Class for a Timeline of images and manipulations for linear interpolation
 #
 
+import collections
 import json
+import os
+import time
 from PIL import Image
 import threading
+import multiprocessing
+import numpy
 
 from interpimage import *
+from framecache import *
+from diskcache import *
+from renderplan import *
+from pixelengine import *
+from maskcache import *
+from sourceindex import *
+from sinks import *
+from manifest import *
+from tracing import *
+from sourcestats import *
+from shards import *
+from budget import *
+
+# extensions naming the same output format
+FORMAT_ALIASES = {"jpeg": "jpg", "tiff": "tif"}
 
 
 class Timeline(object):
 
-    def __init__(self, fname):
+    def __init__(self, fname, preview=None, every=None, trace=None):
+        self.conffile = fname
         self.config = json.loads(open(fname, "r").read())
+        self.preview = preview or lookupDef(self.config, "preview", 1)
+        self.every = every or lookupDef(self.config, "every", 1)
+        self.tracefile = trace or lookupDef(self.config, "trace", None)
+        self.progressinterval = lookupDef(self.config, "progressinterval",
+                                          10.0)
 
         self.crop = lookupDef(self.config, "crop", None)
         if self.crop is not None:
@@ -27,31 +53,68 @@ class Timeline(object):
                 self.scale = None
         self.rotate = lookupDef(self.config, "rotate", None)
         self.nothreads = lookupDef(self.config, "nothreads", 5)
+        self.renderer = lookupDef(self.config, "renderer", None)
+        self.noprocesses = lookupDef(self.config, "noprocesses",
+                                     multiprocessing.cpu_count())
+        self.chunkframes = lookupDef(self.config, "chunkframes", None)
+        self.engine = lookupDef(self.config, "engine", "pil")
+        self.sinkspec = lookupDef(self.config, "sink", None)
+        self.fps = lookupDef(self.config, "fps", 25)
+        self.sinkwindow = lookupDef(self.config, "sinkwindow", 32)
+        self.encoders = lookupDef(self.config, "encoders", 2)
+        self.incremental = lookupDef(self.config, "incremental", True)
+        self.dedup = lookupDef(self.config, "dedup", "link")
+        self.repeats = {}
+        self.framerange = None
+        self.memory = parseBudget(lookupDef(self.config, "memory", None))
+        self.governor = None
+        self.workercache = None
+        self.todo = None
+        self.manifest = None
+        self.hashes = None
+        self.rendered = 0
+        self.engines = []
+        self.enginelock = threading.Lock()
+        self.holdfrom = None
+        self.cache = FrameCache(lookupDef(self.config, "cachebytes",
+                                          1024 * 1024 * 1024))
+        self.disk = None
+        diskcache = lookupDef(self.config, "diskcache", None)
+        if diskcache:
+            self.disk = DiskCache(diskcache,
+                                  lookupDef(self.config, "diskcachebytes",
+                                            4 * 1024 * 1024 * 1024))
 
         self.curves = None
         curves = lookupDef(self.config, "curves", None)
         if curves is not None:
-            rgb = json.loads(open(curves, "r").read())
-            self.curves = rgb["red"] + rgb["blue"] + rgb["green"]
-
-        self.filelist = [InterpImage(x["name"], lookupDef(x, "time", None),
-                                     lookupDef(x, "gamma", (1.0, 1.0, 1.0)),
-                                     lookupDef(x, "mask", None),
-                                     lookupDef(x, "blur", 0),
-                                     lookupDef(x, "ac", 0),
-                                     self.crop, self.scale,
-                                     self.rotate, self.curves)
-                         for x in self.config["filelist"]]
+            self.curves = loadCurves(curves)
+        self.curvestage = lookupDef(self.config, "curvestage", "load")
+        self.fastblur = lookupDef(self.config, "fastblur", True)
+        self.fusedgeometry = lookupDef(self.config, "fusedgeometry", True)
+
+        self.filelist = [self.newSource(x) for x in self.config["filelist"]]
+
+        untimed = [i for i in self.filelist if i.ctime is None]
+        if lookupDef(self.config, "index", True):
+            times = scanTimes([i.filename for i in untimed],
+                              lookupDef(self.config, "scanthreads", 8))
+            for (i, t) in zip(untimed, times):
+                i.ctime = t
 
         self.filelist = sorted(self.filelist, key=lambda x: x.imageCtime())
+        self.setTracer(Tracer(interval=None))
 
         self.inpattern = self.config["inpattern"]
         self.outdir = self.config["outdir"]
+        if self.preview > 1:
+            self.outdir = os.path.join(self.outdir, "preview-%d" % self.preview)
         self.outformat = self.config["outformat"]
         self.noframes = self.config["noframes"]
 
         if self.outformat is None:
             self.outformat = "jpg"
+        self.outoptions = lookupDef(self.config, "outoptions", {})
 
         self.gammas = []
         self.gammas += map(lambda i: (i.imageCtime(), tuple(i.gamma)),
@@ -72,6 +135,9 @@ class Timeline(object):
             pass
 
         self.masks = sorted(self.masks, key=lambda s: s[0])
+        self.maskcache = MaskCache(sorted(set(m for (t, m) in self.masks
+                                              if m is not None)),
+                                   self.filelist[0])
 
         self.blur = []
         self.blur += map(lambda i: (i.imageCtime(), i.blur), self.filelist)
@@ -90,6 +156,89 @@ class Timeline(object):
             pass
 
         self.ac = sorted(self.ac, key=lambda s: s[0])
+        self.acmode = lookupDef(self.config, "acmode", "source")
+        self.deflicker = lookupDef(self.config, "deflicker", 0)
+        self.scanthreads = lookupDef(self.config, "scanthreads", 8)
+        self._stats = None
+
+        self._plan = None
+        self._identities = None
+        self._sourcemodes = {}
+        self.since = None
+        self.frameinterval = None
+        interval = lookupDef(self.config, "frameinterval", None)
+        if interval:
+            self.setFrameInterval(interval)
+
+    def newSource(self, x):
+        "Return the InterpImage for filelist entry X"
+        loadcurves = self.curves
+        if self.curvestage == "render":
+            loadcurves = None
+        return InterpImage(x["name"], lookupDef(x, "time", None),
+                           lookupDef(x, "gamma", (1.0, 1.0, 1.0)),
+                           lookupDef(x, "mask", None),
+                           lookupDef(x, "blur", 0),
+                           lookupDef(x, "ac", 0),
+                           self.crop, self.scale,
+                           self.rotate, loadcurves, self.cache,
+                           self.preview, self.fusedgeometry,
+                           self.disk)
+
+    def setFrameInterval(self, interval):
+        """Space frames INTERVAL seconds of source time apart from the first
+           source, as many as the sources span, rather than spreading
+           `noframes' over them; frames keep their times as sources are added
+
+        """
+        self.frameinterval = float(interval)
+        self.noframes = int((self.maxTime() - self.minTime()) //
+                            self.frameinterval) + 1
+        self._plan = None
+
+    def addSources(self, fnames):
+        """Add source files FNAMES with default gamma, mask, blur and
+           auto-contrast, indexing and scanning only them, and return the
+           first frame whose output they can change; with a frame interval,
+           frames are added to span them
+
+        """
+        oldfiles = [i.filename for i in self.filelist]
+        mintime = self.minTime()
+        new = [self.newSource({"name": f}) for f in fnames]
+        if lookupDef(self.config, "index", True):
+            for (i, t) in zip(new, scanTimes(fnames, self.scanthreads)):
+                i.ctime = t
+        for i in new:
+            i.tracer = self.tracer
+            t = i.imageCtime()
+            self.gammas.append((t, (1.0, 1.0, 1.0)))
+            self.masks.append((t, None))
+            self.blur.append((t, 0))
+            self.ac.append((t, 0))
+        for track in (self.gammas, self.masks, self.blur, self.ac):
+            track.sort(key=lambda s: s[0])
+        self.filelist = sorted(self.filelist + new,
+                               key=lambda x: x.imageCtime())
+        self._plan = None
+        if self._identities is not None:
+            self._identities.update((f, fileIdentity(f)) for f in fnames)
+        if self._stats is not None:
+            known = dict(zip(oldfiles, self._stats[0]))
+            known.update(zip(fnames, scanStats(new, self.scanthreads)))
+            stats = [known[i.filename] for i in self.filelist]
+            self._stats = (stats, deflickerGains(stats, self.deflicker))
+
+        if self.frameinterval is None or self.minTime() < mintime:
+            return 0
+        self.setFrameInterval(self.frameinterval)
+        # a new source changes the blend from its predecessor on, and
+        # deflicker gains over half a window before that
+        first = min(self.filelist.index(i) for i in new) - 1
+        if self.deflicker >= 2:
+            first -= self.deflicker // 2
+        t = self.fileTimes()[max(first, 0)]
+        return int((t - mintime) // self.frameinterval)
 
     def fileTimes(self):
         return [x.imageCtime() for x in self.filelist]
@@ -107,86 +256,178 @@ class Timeline(object):
            time proportion
 
         """
-        idx = 0
-        while ((self.filelist[idx].imageCtime() < t) and
-               idx < len(self.filelist) - 1):
-            idx += 1
-        idx = max(0, idx - 1)
-        rem = t - (self.filelist[idx].imageCtime())
-        diff = (self.filelist[idx + 1].imageCtime() -
-                self.filelist[idx].imageCtime())
-        try:
-            r = float(rem) / diff
-        except:
-            r = 0.0
-        return (idx, r)
+        idx, r = keyframeIndex(self.fileTimes(), t)
+        return (int(idx), float(r))
 
     def gammaAtTime(self, t):
         "Find gamma at given time T"
-        idx = 0
-        while (self.gammas[idx][0] < t) and (idx <= len(self.gammas) - 1):
-            idx += 1
-        idx -= 1
-        t1, t2 = self.gammas[idx][0], self.gammas[idx + 1][0]
-        g1, g2 = self.gammas[idx][1], self.gammas[idx + 1][1]
-        rem = float(t - t1)
-        factor = float(rem) / (t2 - t1)
-        if type(g1) == tuple:
-            rgamma = float(g1[0]) + (g2[0] - g1[0]) * factor
-            ggamma = float(g1[1]) + (g2[1] - g1[1]) * factor
-            bgamma = float(g1[2]) + (g2[2] - g1[2]) * factor
-            return (rgamma, ggamma, bgamma)
-        else:
-            g = g1 + (g2 - g1) * factor
-            return (g, g, g)
+        g = interpTrack([(k, gammaTriple(v)) for (k, v) in self.gammas], t)
+        return tuple(float(x) for x in g)
 
     def blurAtTime(self, t):
         "Find blur at given time T"
-        idx = 0
-        while (self.blur[idx][0] < t) and (idx <= len(self.blur) - 1):
-            idx += 1
-        idx -= 1
-        t1, t2 = self.blur[idx][0], self.blur[idx + 1][0]
-        b1, b2 = self.blur[idx][1], self.blur[idx + 1][1]
-        factor = float(t - t1) / (t2 - t1)
-        b = float(b1) + float(b2 - b1) * factor
-        return b
+        return float(interpTrack(self.blur, t))
 
     def acAtTime(self, t):
         """Find auto-correction factor at given time T"""
-        idx = 0
-        while (self.ac[idx][0] < t) and (idx <= len(self.ac) - 1):
-            idx += 1
-        if idx > 0:
-            idx -= 1
-        t1, t2 = self.ac[idx][0], self.ac[idx + 1][0]
-        b1, b2 = self.ac[idx][1], self.ac[idx + 1][1]
-        factor = float(t - t1) / float(t2 - t1)
-        b = float(b1) + float(b2 - b1) * factor
-        return b
+        return float(interpTrack(self.ac, t))
+
+    def usesLevels(self):
+        "Whether frames need the per-source histogram stats"
+        return self.deflicker >= 2 or (self.acmode == "source" and
+                                       any(v != 0 for (t, v) in self.ac))
+
+    def sourceStats(self):
+        """Return the histogram stats and deflicker gain of every source,
+           scanning sources missing from the index on first use
+
+        """
+        if self._stats is None:
+            stats = scanStats(self.filelist, self.scanthreads)
+            self._stats = (stats, deflickerGains(stats, self.deflicker))
+        return self._stats
+
+    def levels(self, idx, rem, ac):
+        """Return the (3,256) deflicker and auto-contrast table for sources
+           IDX,IDX+1 blended by REM, or None
+
+        """
+        if not self.usesLevels():
+            return None
+        if self.acmode != "source":
+            ac = 0.0
+        stats, gains = self.sourceStats()
+        return levelsTable(stats[idx], stats[idx + 1], rem, ac, gains[idx],
+                           gains[idx + 1])
 
     def maskAtTime(self, t):
         """Compute an image mask for time T"""
-        idx = 0
-        while (self.masks[idx][0] <= t) and (idx < len(self.gammas)):
-            idx += 1
-        if idx > 0:
-                idx -= 1
-        t1, t2 = self.masks[idx][0], self.masks[idx + 1][0]
-        m1, m2 = self.masks[idx][1], self.masks[idx + 1][1]
-        factor = (t - t1) / float(t2 - t1)
-        if m1 is not None and m2 is not None:
-            a = Image.open(m1).convert("RGB")
-            b = Image.open(m2).convert("RGB")
-            ret = a
-            try:
-                ret = Image.blend(a, b, factor)
-            except ValueError:
-                print("Images of differing sizes: m1=(%d,%d), m2=(%d,%d)" %
-                      (a.size + b.size))
-            return ret
-        else:
+        return self.maskImage(*self.maskSpec(t))
+
+    def maskSpec(self, t):
+        "Return the (mask1, mask2, factor) in effect at time T"
+        times = [k[0] for k in self.masks]
+        idx, factor = keyframeIndex(times, t, side="right")
+        m1 = self.masks[idx][1]
+        m2 = self.masks[min(idx + 1, len(self.masks) - 1)][1]
+        return (m1, m2, float(factor))
+
+    def maskImage(self, m1, m2, factor):
+        "Blend mask files M1 and M2 by FACTOR; None if either is missing"
+        return self.maskcache.image(m1, m2, factor)
+
+    def plan(self):
+        "Return the compiled RenderPlan for the current number of frames"
+        if self._plan is None or self._plan.noframes != self.noframes:
+            self._plan = RenderPlan(self)
+        return self._plan
+
+    def frameKey(self, n):
+        """Return a tuple of everything that determines the output of frame N,
+           with file contents identified by path, size and mtime
+
+        """
+        if self._identities is None:
+            self._identities = dict(
+                (f, fileIdentity(f))
+                for f in set(self.plan().filenames + self.plan().maskfiles))
+        p = self.plan().frame(n)
+        ident = self._identities
+        f1 = ident[self.filelist[p["source"]].filename]
+        f2 = ident[self.filelist[p["source"] + 1].filename]
+        ratio = p["ratio"]
+        # a blend of a file with itself, or wholly of one side, is that file
+        if ratio == 1.0:
+            f1 = f2
+        if f1 == f2 or ratio == 0.0:
+            f2, ratio = None, 0.0
+        m1, m2, mf = p["mask1"], p["mask2"], p["maskfactor"]
+        if m1 is not None:
+            if m1 == m2 or mf == 0.0:
+                m2, mf = None, 0.0
+            elif mf == 1.0:
+                m1, m2, mf = m2, None, 0.0
+            m1 = ident[m1]
+            m2 = m2 and ident[m2]
+        levels = self.levels(p["source"], p["ratio"], p["ac"])
+        if levels is not None:
+            levels = frameHash(levels.tobytes())
+        return (self.settingsKey(), f1, f2, round(ratio, 6),
+                quantize(p["gamma"]), round(p["blur"], 6), round(p["ac"], 6),
+                m1, m2, round(mf, 6), levels)
+
+    def sourceFile(self, n):
+        """Return the source file that frame N reproduces unaltered, as the
+           output format with no geometry, tone or effects, else None
+
+        """
+        if (self.crop or self.scale or self.rotate or self.curves or
+                self.preview > 1 or self.outoptions):
+            return None
+        p = self.plan().frame(n)
+        if p["ratio"] not in (0.0, 1.0):
+            return None
+        if (any(g != 1.0 for g in quantize(p["gamma"])) or p["blur"] or
+                p["ac"] or p["mask1"] is not None or
+                self.levels(p["source"], p["ratio"], p["ac"]) is not None):
+            return None
+        fname = self.filelist[p["source"] + int(p["ratio"])].filename
+        ext = os.path.splitext(fname)[1][1:].lower()
+        if (FORMAT_ALIASES.get(ext, ext) !=
+                FORMAT_ALIASES.get(self.outformat.lower(), self.outformat)):
             return None
+        if fname not in self._sourcemodes:
+            self._sourcemodes[fname] = Image.open(fname).mode
+        if self._sourcemodes[fname] != "RGB":
+            return None
+        return fname
+
+    def planRepeats(self, complete=None):
+        """Point each frame to be rendered whose inputs match an earlier
+           frame's, or that reproduces a source file unaltered, at that frame
+           or file in self.repeats, and drop it from self.todo; frames flagged
+           in COMPLETE are already on disk and can be repeated too
+
+        """
+        self.repeats = {}
+        if not self.dedup:
+            return
+        if self.hashes is None:
+            self.hashes = self.frameHashes()
+        if self.todo is None:
+            self.todo = numpy.ones(self.noframes, dtype=bool)
+        files = isinstance(self.sink, ImageSequenceSink)
+        first = {}
+        for n in range(self.since or 0, self.noframes):
+            h = self.hashes[n]
+            if self.todo[n]:
+                source = first.get(h)
+                if source is None and files:
+                    source = self.sourceFile(n)
+                if source is None:
+                    first[h] = n
+                else:
+                    first.setdefault(h, source)
+                    self.repeats[n] = source
+                    self.todo[n] = False
+            elif complete is not None and complete[n]:
+                first.setdefault(h, n)
+        if self.repeats:
+            print("%d frames repeat an earlier frame or a source file" %
+                  len(self.repeats))
+
+    def settingsKey(self):
+        "Return the global settings that affect every frame's output"
+        return (self.crop, self.scale, self.rotate, self.curves and
+                frameHash(self.curves), self.curvestage, self.engine,
+                self.fastblur, self.fusedgeometry, self.outformat,
+                frameHash(self.outoptions), self.preview, self.acmode,
+                self.deflicker)
+
+    def frameHashes(self, first=0):
+        "Return the input hash of every frame from FIRST on"
+        return [frameHash(self.frameKey(n))
+                for n in range(first, self.noframes)]
 
     def __str__(self):
         """Return string representation of self S"""
@@ -197,64 +438,462 @@ class Timeline(object):
                  str(self.masks), str(self.blur), str(self.ac), self.noframes,
                  self.outdir))
 
+    def setTracer(self, tracer):
+        "Instrument rendering and source decoding with TRACER"
+        self.tracer = tracer
+        for i in self.filelist:
+            i.tracer = tracer
+
+    def cacheStatus(self):
+        "Describe the source cache hit rate, including worker processes"
+        hits = self.cache.hits + self.tracer.counters.get("cachehits", 0)
+        misses = self.cache.misses + self.tracer.counters.get("cachemisses", 0)
+        return "cache %.0f%% hits" % (100.0 * hits / max(hits + misses, 1))
+
     def frameAtTime(self, t, fname=None):
         idx, rem = self.filesAtTime(t)
         g = self.gammaAtTime(t)
         blur = self.blurAtTime(t)
-        msk = self.maskAtTime(t)
+        msk = self.maskSpec(t)
         ac = self.acAtTime(t)
-        print("Image t=%f, g=(%f,%f,%f), blur=%f, ac=%f, f1=%s, f2=%s" %
-              (t, g[0], g[1], g[2], blur, ac,
-               self.filelist[idx].filename, self.filelist[idx + 1].filename))
-        result = self.filelist[idx].interp(self.filelist[idx + 1], rem)
-        result = imageAutoContrast(result, ac)
-        result = imageMask(result, msk)
-        result = imageGamma(result, g)
-        result = imageBlur(result, blur)
+        return self.renderFrame(t, idx, rem, g, blur, ac, msk, fname)
+
+    def frameAt(self, n, fname=None):
+        "Render frame N of the compiled plan"
+        p = self.plan().frame(n)
+        msk = (p["mask1"], p["mask2"], p["maskfactor"])
+        return self.renderFrame(p["time"], p["source"], p["ratio"], p["gamma"],
+                                p["blur"], p["ac"], msk, fname)
+
+    def renderFrame(self, t, idx, rem, g, blur, ac, msk, fname=None):
+        """Interpolate sources IDX,IDX+1 by REM and apply the effect chain;
+           MSK is a (mask1, mask2, factor) triple
+
+        """
+        span = self.tracer.span
+        if self.engine == "numpy":
+            a = self.filelist[idx].pixels
+            b = self.filelist[idx + 1].pixels
+            with span("fused"):
+                result = self.fusedFrame(idx, rem, g, ac, msk, a, b)
+        else:
+            a = self.filelist[idx].image
+            b = self.filelist[idx + 1].image
+            with span("blend"):
+                result = imageBlend(a, b, rem).convert("RGB")
+            with span("ac"):
+                levels = self.levels(idx, rem, ac)
+                if levels is not None:
+                    result = result.point(levels.ravel().tolist())
+                if self.acmode == "frame":
+                    result = imageAutoContrast(result, ac)
+            with span("mask"):
+                result = imageMask(result, self.maskImage(*msk))
+            with span("gamma"):
+                result = imageTone(result, g, self.renderCurves())
+        # blur degree is proportional to variance in pixels, so shrinks with
+        # the square of the preview reduction
+        with span("blur"):
+            result = imageBlur(result, blur / self.preview ** 2, self.fastblur)
         if fname is not None:
-            result.save(fname)
+            with span("encode"):
+                result.save(fname, **self.outoptions)
         return result
 
-    def renderLinear(self, nframes=None):
+    def renderCurves(self):
+        "Curves to fold into the per-frame tone LUT, if not applied at load"
+        if self.curvestage == "render":
+            return self.curves
+        return None
+
+    def fusedFrame(self, idx, rem, g, ac, msk, a=None, b=None):
+        """Blend, auto-contrast, mask and gamma in one pass of the NumPy
+           engine; A and B are the sources' pixels, if already at hand
+
+        """
+        if a is None:
+            a = self.filelist[idx].pixels
+        if b is None:
+            b = self.filelist[idx + 1].pixels
+        gamma = toneArray(g, self.renderCurves())
+        levels = self.levels(idx, rem, ac)
+        if self.acmode != "frame":
+            ac = 0.0
+        # engines, with their buffers, outlive the per-frame render threads
+        with self.enginelock:
+            fused = self.engines.pop() if self.engines else FusedEngine()
+        try:
+            return fused.render(a, b, rem, ac, self.maskcache.array(*msk),
+                                gamma, levels)
+        finally:
+            with self.enginelock:
+                self.engines.append(fused)
+
+    def frameName(self, n):
+        "Output filename for frame N"
+        return "%s/result-%05d.%s" % (self.outdir, n, self.outformat)
+
+    def prefetch(self, idx):
+        "Start decoding the keyframe pair following source IDX"
+        pair = self.filelist[idx + 1:idx + 3]
+        self.cache.prefetch([i.cacheItem(self.engine == "numpy")
+                             for i in pair])
+
+    def slideWindow(self, idx):
+        """Move the decoded-source window forward to the pair IDX,IDX+1,
+           releasing earlier sources that will not be needed again; sources
+           from self.holdfrom on are kept for frames queued but not yet run
+
+        """
+        low = idx if self.holdfrom is None else min(idx, self.holdfrom)
+        keep = set(i.filename for i in self.filelist[low:idx + 3])
+        for i in self.filelist[:low]:
+            if i.filename not in keep:
+                i.reap()
+        self.prefetch(idx)
+
+    def openSink(self, first=0):
+        "Open the configured output sink, starting at frame FIRST"
+        return openSink(self.sinkspec,
+                        "%s/result-%%05d.%s" % (self.outdir, self.outformat),
+                        self.fps, self.sinkwindow, first, self.outoptions,
+                        self.encoders, self.frameDone)
+
+    def frameDone(self, n):
+        "Record in the manifest that frame N is written out in full"
+        if self.manifest is not None:
+            self.manifest.record(n, self.hashes[n])
+
+    def renderTo(self, sink, n):
+        "Render frame N into SINK"
+        with self.tracer.frame(n):
+            sink.write(n, self.frameAt(n))
+
+    def schedule(self, sink, first=0, last=None):
+        """Yield (source, frames) for each source pair in [FIRST, LAST), with
+           the decoded-source window moved to it, listing the frames still to
+           be rendered; the others are skipped in SINK
+
+        """
+        for (idx, start, stop) in self.plan().segments(first, last):
+            frames = []
+            for n in range(start, stop):
+                if self.todo is None or self.todo[n]:
+                    frames.append(n)
+                elif n not in self.repeats:
+                    sink.skip(n)
+            if frames:
+                self.slideWindow(idx)
+                self.rendered += len(frames)
+                yield (idx, frames)
+
+    def renderSegments(self, first=0, last=None, sink=None):
+        """Render frames [FIRST, LAST) pair by pair into SINK, streaming
+           forward so each source is decoded once; returns the number of
+           decodes
+
+        """
+        decodes = self.cache.misses
+        for (idx, frames) in self.schedule(sink, first, last):
+            for n in frames:
+                self.renderTo(sink, n)
+        return self.cache.misses - decodes
+
+    def renderLinear(self, nframes=None, sink=None):
         if nframes:
             self.noframes = nframes
-        mint = self.minTime()
-        maxt = self.maxTime()
-        for n in range(self.noframes):
-            t = float(n) / self.noframes * (maxt - mint) + mint
-            result = self.frameAtTime(t)
-            result.save("%s/result-%05d.%s" % (self.outdir, n, self.outformat))
-            [i.reap() for i in self.filelist]
-
-    def renderThreads(self, nthreads=5):
-        mint = self.minTime()
-        maxt = self.maxTime()
+        out = sink or self.openSink()
+        self.decodes = self.renderSegments(0, None, out)
+        if sink is None:
+            out.close()
+        print(str(self.cache))
+        if self.disk is not None:
+            print(str(self.disk))
+
+    def renderThreads(self, nthreads=5, sink=None):
+        out = sink or self.openSink()
+        decodes = self.cache.misses
         threads = []
-        n = 0
-        while n < self.noframes:
-            t = float(n) / self.noframes * (maxt - mint) + mint
-            idx, rem = self.filesAtTime(t)
-            threads.append(
-                threading.Thread(target=self.frameAtTime,
-                                 args=(t, ("%s/result-%05d.%s" %
-                                           (self.outdir, n, self.outformat)))))
-            if len(threads) == nthreads:
-                [t.start() for t in threads]
-                [t.join() for t in threads]
-                if idx > 5:
-                    [i.reap() for i in self.filelist[:idx - 2]]
-                threads = []
-            n += 1
+        batch = nthreads
+        for (idx, frames) in self.schedule(out):
+            for n in frames:
+                if not threads:
+                    self.holdfrom = idx
+                threads.append(
+                    threading.Thread(target=self.renderTo, args=(out, n)))
+                if len(threads) >= batch:
+                    [t.start() for t in threads]
+                    [t.join() for t in threads]
+                    threads = []
+                    if self.governor is not None:
+                        batch = min(nthreads, self.governor.workers())
         print("Tidying up")
         [t.start() for t in threads]
         [t.join() for t in threads]
+        self.holdfrom = None
+        if sink is None:
+            out.close()
+        self.decodes = self.cache.misses - decodes
+        print(str(self.cache))
+        if self.disk is not None:
+            print(str(self.disk))
+
+    def frameRanges(self, nchunks):
+        "Split the frames into contiguous [start, stop) ranges"
+        size = self.chunkframes
+        if not size:
+            size = max(1, self.noframes // max(1, nchunks))
+        return [(n, min(n + size, self.noframes))
+                for n in range(0, self.noframes, size)]
+
+    def renderProcesses(self, nprocs=None, sink=None):
+        """Render contiguous frame ranges on a persistent pool of NPROCS
+           worker processes, each with its own warm source cache; at most
+           two ranges per worker are in flight at once
+
+        """
+        if nprocs is None:
+            nprocs = self.noprocesses
+        out = sink or self.openSink()
+        stream = not isinstance(out, ImageSequenceSink)
+        ranges = collections.deque(self.frameRanges(nprocs * 4))
+        if self.todo is not None:
+            ranges = collections.deque((a, b) for (a, b) in ranges
+                                       if self.todo[a:b].any())
+            if stream:
+                for n in numpy.nonzero(~self.todo)[0]:
+                    if n not in self.repeats:
+                        out.skip(int(n))
+        pool = multiprocessing.Pool(nprocs, initializer=_initWorker,
+                                    initargs=(self.conffile, self.noframes,
+                                              self.preview,
+                                              self.tracer.enabled,
+                                              self.workercache))
+        self.decodes = 0
+        pending = collections.deque()
+        inflight = nprocs * 2
+        try:
+            while ranges or pending:
+                if self.governor is not None:
+                    inflight = min(nprocs * 2, self.governor.workers())
+                while ranges and len(pending) < inflight:
+                    (a, b) = ranges.popleft()
+                    todo = None if self.todo is None else self.todo[a:b]
+                    pending.append(pool.apply_async(_renderRange,
+                                                    ((a, b), todo, stream)))
+                (first, last, decodes, rendered, frames, trace) = \
+                    pending.popleft().get()
+                for (n, size, data) in frames:
+                    out.write(n, Image.frombytes("RGB", size, data))
+                if not stream:
+                    out.frames += len(rendered)
+                for n in rendered:
+                    if self.manifest is not None:
+                        self.manifest.record(n, self.hashes[n])
+                self.rendered += len(rendered)
+                self.decodes += decodes
+                self.tracer.merge(trace)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        if sink is None:
+            out.close()
+
+    def budgetMemory(self):
+        """Choose the number of workers and source cache size to keep the
+           render within the configured memory budget, and a governor to
+           throttle it if memory nears the budget all the same
 
-    def render(self):
-        print("Rendering with %d threads" % self.nothreads)
-        if self.nothreads == 1:
-            self.renderLinear()
+        """
+        mincache = WINDOW_SOURCES * sourceBytes(self)
+        if self.renderer == "processes":
+            (self.noprocesses, self.workercache) = planProcesses(
+                self, self.memory, self.noprocesses, self.cache.maxbytes)
+            self.governor = Governor(self.memory, self.noprocesses * 2,
+                                     measure=processTreeRSS)
         else:
-            self.renderThreads(nthreads=self.nothreads)
+            (threads, cachebytes) = planThreads(self, self.memory,
+                                                self.nothreads,
+                                                self.cache.maxbytes)
+            if self.renderer != "linear":
+                self.nothreads = threads
+            self.cache.resize(cachebytes)
+            self.governor = Governor(self.memory, self.nothreads, self.cache,
+                                     mincache)
+
+    def planIncremental(self, force=False):
+        """Open the manifest in the output directory, or this shard's own if
+           rendering a frame range, and flag in self.todo the frames whose
+           inputs changed or whose output is missing or truncated; FORCE flags
+           every frame
+
+        """
+        if self.framerange is None:
+            self.manifest = Manifest(os.path.join(self.outdir, MANIFEST_NAME))
+            known = self.manifest.hashes
+        else:
+            self.manifest = Manifest(os.path.join(
+                self.outdir, shardName(*self.framerange) + ".jsonl"))
+            known = readManifests(self.outdir)
+        # frames before self.since are taken to be up to date unexamined
+        since = self.since or 0
+        self.hashes = ([known.get(n) for n in range(since)] +
+                       self.frameHashes(since))
+        self.todo = numpy.ones(self.noframes, dtype=bool)
+        self.todo[:since] = False
+        if not force:
+            for n in range(since, self.noframes):
+                if (known.get(n) == self.hashes[n] and
+                        frameComplete(self.frameName(n))):
+                    self.todo[n] = False
+        print("%d of %d frames need rendering" %
+              (self.todo.sum(), self.noframes))
+
+    def render(self, force=False):
+        start = time.time()
+        self.decodes = 0
+        self.rendered = 0
+        if self.preview > 1 and not os.path.isdir(self.outdir):
+            os.makedirs(self.outdir)
+        self.sink = self.openSink()
+        if (self.framerange is not None and
+                not isinstance(self.sink, ImageSequenceSink)):
+            raise ValueError("Only image sequences can be rendered in shards")
+        self.todo = None
+        if self.usesLevels():
+            print("Reading source histograms")
+            self.sourceStats()
+        if ((self.incremental or self.framerange is not None) and
+                isinstance(self.sink, ImageSequenceSink)):
+            self.planIncremental(force or not self.incremental)
+        complete = None if self.todo is None else ~self.todo
+        if self.framerange is not None:
+            (first, last) = self.framerange
+            outside = numpy.ones(self.noframes, dtype=bool)
+            outside[first:last] = False
+            self.todo[outside] = False
+            complete[outside] = False
+            print("Rendering frames %d-%d: %d frames" %
+                  (first, last - 1, self.todo.sum()))
+        if self.every > 1:
+            if self.todo is None:
+                self.todo = numpy.ones(self.noframes, dtype=bool)
+            self.todo[numpy.arange(self.noframes) % self.every != 0] = False
+            print("Rendering every %dth frame: %d frames" %
+                  (self.every, self.todo.sum()))
+        self.planRepeats(complete)
+        for (n, source) in sorted(self.repeats.items()):
+            self.sink.repeat(n, source, self.dedup == "copy")
+        self.setTracer(Tracer(self.tracefile, self.progressinterval,
+                              status=self.cacheStatus))
+        self.tracer.total = (self.noframes if self.todo is None
+                             else int(self.todo.sum()))
+        self.sink.tracer = self.tracer
+        if self.memory:
+            self.budgetMemory()
+        try:
+            if self.renderer == "processes":
+                print("Rendering with %d processes" % self.noprocesses)
+                self.renderProcesses(sink=self.sink)
+            elif (self.renderer == "linear" or
+                  (self.renderer is None and self.nothreads == 1)):
+                print("Rendering linearly")
+                self.renderLinear(sink=self.sink)
+            else:
+                print("Rendering with %d threads" % self.nothreads)
+                self.renderThreads(nthreads=self.nothreads, sink=self.sink)
+        finally:
+            self.sink.close()
+            if self.manifest is not None:
+                self.manifest.close(self.noframes)
+            self.tracer.count("byteswritten", self.sink.bytes)
+            self.tracer.close()
+        elapsed = time.time() - start
+        print("Output: %s" % self.sink)
+        print("Rendered %d frames in %.1fs, %.2f frames/sec, %d source decodes"
+              % (self.rendered, elapsed, self.rendered / max(elapsed, 1e-6),
+                 self.decodes))
+        if self.repeats:
+            print("Deduplicated %d frames, %d of them reusing source files" %
+                  (len(self.repeats),
+                   sum(isinstance(s, str) for s in self.repeats.values())))
+        print("Stage times:\n" + "\n".join(self.tracer.report()))
+        (count, seconds) = self.tracer.totals.get("encode", (0, 0.0))
+        print("Encoded %d frames in %.1fs, %.1fms each, %s" %
+              (count, seconds, 1000.0 * seconds / max(count, 1),
+               "%d encoder threads" % self.encoders
+               if isinstance(self.sink, ImageSequenceSink) and self.encoders
+               else "inline"))
+        print("Read %.1fMB, wrote %.1fMB, peak RSS %.0fMB, %s" %
+              (self.tracer.counters.get("bytesread", 0) / 1048576.0,
+               self.tracer.counters.get("byteswritten", 0) / 1048576.0,
+               peakRSS() / 1048576.0, self.cacheStatus()))
+        if self.governor is not None:
+            print(str(self.governor))
+        if self.tracefile:
+            print("Trace written to %s" % self.tracefile)
+        if self.framerange is not None:
+            print("Shard complete: %s" %
+                  writeShardRecord(self.outdir, self.framerange[0],
+                                   self.framerange[1], self.hashes,
+                                   self.rendered + len(self.repeats)))
+
+
+_worker = None
+
+
+def _initWorker(conffile, noframes, preview, trace=False, cachebytes=None):
+    """Build the per-process Timeline used by _renderRange, keeping trace
+       records for the parent if TRACE and caching at most CACHEBYTES of
+       sources if given"""
+    global _worker
+    _worker = Timeline(conffile, preview)
+    _worker.noframes = noframes
+    if cachebytes is not None:
+        _worker.cache.resize(cachebytes)
+    if trace:
+        _worker.setTracer(Tracer(interval=None, collect=True))
+
+
+class _FrameList(list):
+    "Collects frames rendered by a worker, to be written by the parent"
+
+    def write(self, n, img):
+        self.append((n, img.size, img.tobytes()))
+
+    def skip(self, n):
+        pass
+
+
+def _renderRange(r, todo=None, stream=False):
+    """Render frames in the range R=(start, stop) in a worker process, only
+       those flagged in TODO if given; if STREAM, return them for the parent's
+       sink rather than saving them
+
+    """
+    first, last = r
+    frames = _FrameList()
+    sink = frames if stream else _worker.openSink()
+    if not stream:
+        sink.tracer = _worker.tracer
+    _worker.todo = None
+    if todo is not None:
+        _worker.todo = numpy.zeros(_worker.noframes, dtype=bool)
+        _worker.todo[first:last] = todo
+    rendered = [n for n in range(first, last)
+                if todo is None or todo[n - first]]
+    hits = _worker.cache.hits
+    decodes = _worker.renderSegments(first, last, sink)
+    tracer = _worker.tracer
+    tracer.count("cachehits", _worker.cache.hits - hits)
+    tracer.count("cachemisses", decodes)
+    if not stream:
+        sink.close()
+        tracer.count("byteswritten", sink.bytes)
+    return (first, last, decodes, rendered, frames, tracer.drain())
 
 
 def test():
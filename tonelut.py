@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+#
+# Tone mapping: config curves and per-channel gamma composed into a single
+# 768-entry lookup table, memoized by quantized gamma
+#
+
+import json
+import numpy
+from functools import lru_cache
+
+GAMMA_QUANTUM = 0.001
+IDENTITY = (1.0, 1.0, 1.0)
+
+
+def loadCurves(fname):
+    "Read a gen-curve.py JSON file into a 768-entry R,G,B lookup table"
+    rgb = json.loads(open(fname, "r").read())
+    return tuple(rgb["red"] + rgb["green"] + rgb["blue"])
+
+
+def quantize(g):
+    "Round gamma triple G to GAMMA_QUANTUM so near-identical frames share LUTs"
+    return tuple(round(float(x) / GAMMA_QUANTUM) * GAMMA_QUANTUM for x in g)
+
+
+def gammaCurve(g, depth=256):
+    "Return the DEPTH-entry lookup table for a single gamma value G"
+    return [int(depth * (float(x) / depth) ** (1.0 / g)) for x in range(depth)]
+
+
+@lru_cache(maxsize=1024)
+def _toneTable(g, curves):
+    table = []
+    for c in range(3):
+        curve = gammaCurve(g[c])
+        if curves is None:
+            table += curve
+        else:
+            table += [curve[v] for v in curves[c * 256:(c + 1) * 256]]
+    return tuple(table)
+
+
+def toneTable(g=IDENTITY, curves=None):
+    """Return the 768-entry table applying CURVES (a 768-tuple, or None) and
+       then gamma triple G, or None if that would be the identity
+
+    """
+    g = quantize(g)
+    if g == IDENTITY and curves is None:
+        return None
+    return _toneTable(g, curves)
+
+
+@lru_cache(maxsize=1024)
+def _toneArray(table):
+    arr = numpy.asarray(table, dtype=numpy.uint8).reshape(3, 256)
+    arr.flags.writeable = False
+    return arr
+
+
+def toneArray(g=IDENTITY, curves=None):
+    "As toneTable(), but as a read-only (3,256) uint8 array"
+    table = toneTable(g, curves)
+    if table is None:
+        return None
+    return _toneArray(table)
+
+
+def imageTone(img, g=IDENTITY, curves=None):
+    "Apply CURVES then gamma triple G to IMG in a single point operation"
+    table = toneTable(g, curves)
+    if table is None:
+        return img
+    return img.point(list(table))
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+#
+# Render instrumentation: per-frame and per-stage timings, counters and a
+# periodic throughput line, optionally written out as JSON lines (one record
+# per frame) or as Chrome trace events (a .json file for chrome://tracing)
+#
+
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peakRSS():
+    "Return the peak resident set size of this process in bytes, or 0"
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def currentRSS(pid=None):
+    """Return the resident set size of process PID, by default this one, in
+       bytes; 0 where /proc is not available
+
+    """
+    try:
+        f = open("/proc/%s/statm" % (pid or "self"))
+        pages = int(f.read().split()[1])
+        f.close()
+    except (IOError, OSError, ValueError, IndexError):
+        return 0
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+
+def formatDuration(s):
+    "Format S seconds as H:MM:SS"
+    s = int(s)
+    return "%d:%02d:%02d" % (s // 3600, s // 60 % 60, s % 60)
+
+
+class Tracer(object):
+    """Collects stage timings and counters for a render. Records go to FNAME
+       if given (Chrome trace events if it ends .json, else JSON lines), or
+       are kept for drain() if COLLECT; a progress line is printed every
+       INTERVAL seconds, None for never"""
+
+    def __init__(self, fname=None, interval=10.0, collect=False, status=None):
+        self.fname = fname
+        self.chrome = fname is not None and fname.endswith(".json")
+        self.out = None
+        if fname is not None:
+            self.out = open(fname, "w")
+            if self.chrome:
+                self.out.write('{"traceEvents": [\n')
+        self.collect = collect
+        self.records = []
+        self.interval = interval
+        self.status = status
+        self.totals = {}
+        self.counters = {}
+        self.frames = 0
+        self.total = None
+        self.started = time.time()
+        self.last = self.started
+        self.written = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.pid = os.getpid()
+
+    @property
+    def enabled(self):
+        "Whether records are wanted at all"
+        return self.out is not None or self.collect
+
+    def emit(self, record):
+        "Write or keep one trace record; lock held"
+        if self.out is None:
+            if self.collect:
+                self.records.append(record)
+            return
+        if self.chrome:
+            self.out.write((",\n" if self.written else "") + json.dumps(record))
+        else:
+            self.out.write(json.dumps(record) + "\n")
+        self.written += 1
+
+    def add(self, stage, start, end):
+        "Account STAGE as having run from START to END on this thread"
+        stages = getattr(self.local, "stages", None)
+        if stages is not None:
+            stages[stage] = stages.get(stage, 0.0) + end - start
+        with self.lock:
+            total = self.totals.setdefault(stage, [0, 0.0])
+            total[0] += 1
+            total[1] += end - start
+            if self.chrome or (self.collect and self.out is None):
+                self.emit({"name": stage, "ph": "X", "ts": start * 1e6,
+                           "dur": (end - start) * 1e6, "pid": self.pid,
+                           "tid": threading.current_thread().name,
+                           "args": {"frame": getattr(self.local, "frame",
+                                                     None)}})
+
+    @contextmanager
+    def span(self, stage):
+        "Time the enclosed block as STAGE"
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, start, time.time())
+
+    @contextmanager
+    def frame(self, n):
+        "Time the enclosed block as frame N, collecting the stages run in it"
+        self.local.frame = n
+        self.local.stages = {}
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            stages = self.local.stages
+            self.local.stages = None
+            self.add("frame", start, end)
+            self.local.frame = None
+            with self.lock:
+                self.frames += 1
+                if not self.chrome and self.enabled:
+                    self.emit({"frame": n, "time": start,
+                               "seconds": round(end - start, 6),
+                               "stages": dict((k, round(v, 6)) for (k, v)
+                                              in stages.items()),
+                               "pid": self.pid,
+                               "thread": threading.current_thread().name})
+            self.progress()
+
+    def count(self, name, n=1):
+        "Add N to counter NAME"
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def drain(self):
+        """Return and reset (totals, counters, frames, records), to be merged
+           into the tracer of another process
+
+        """
+        with self.lock:
+            ret = (self.totals, self.counters, self.frames, self.records)
+            self.totals = {}
+            self.counters = {}
+            self.frames = 0
+            self.records = []
+        return ret
+
+    def merge(self, state):
+        "Add the drain()ed STATE of another tracer to this one"
+        (totals, counters, frames, records) = state
+        with self.lock:
+            for (stage, (count, seconds)) in totals.items():
+                total = self.totals.setdefault(stage, [0, 0.0])
+                total[0] += count
+                total[1] += seconds
+            for (name, n) in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            self.frames += frames
+            for record in records:
+                if self.chrome == ("ph" in record):
+                    self.emit(record)
+        self.progress()
+
+    def progress(self, force=False):
+        "Print the throughput line if INTERVAL has passed since the last"
+        now = time.time()
+        with self.lock:
+            if self.interval is None or (not force and
+                                         now - self.last < self.interval):
+                return
+            self.last = now
+        print(self.line())
+
+    def line(self):
+        "Return a one-line throughput, ETA and memory summary"
+        elapsed = max(time.time() - self.started, 1e-6)
+        rate = self.frames / elapsed
+        s = "Progress: %d" % self.frames
+        if self.total:
+            s += "/%d" % self.total
+        s += " frames, %.2f frames/sec" % rate
+        if self.total and rate > 0:
+            s += ", ETA %s" % formatDuration(max(self.total - self.frames, 0)
+                                             / rate)
+        s += ", peak RSS %.0fMB" % (peakRSS() / 1048576.0)
+        if self.status is not None:
+            s += ", " + self.status()
+        return s
+
+    def summary(self):
+        "Return the per-stage totals and counters as a dict"
+        return {
+            "frames": self.frames,
+            "seconds": time.time() - self.started,
+            "stages": dict((k, {"count": v[0], "seconds": round(v[1], 6)})
+                           for (k, v) in self.totals.items()),
+            "counters": dict(self.counters),
+            "peakrss": peakRSS(),
+        }
+
+    def report(self):
+        "Return human-readable lines of per-stage time"
+        stages = sorted(((v[1], k, v[0]) for (k, v) in self.totals.items()
+                         if k != "frame"), reverse=True)
+        busy = sum(s[0] for s in stages) or 1e-6
+        return ["  %-8s %8d calls %10.2fs %8.2fms each %5.1f%%" %
+                (name, count, seconds, 1000.0 * seconds / max(count, 1),
+                 100.0 * seconds / busy)
+                for (seconds, name, count) in stages]
+
+    def close(self):
+        "Finish the trace file with a summary"
+        if self.out is None:
+            return
+        with self.lock:
+            if self.chrome:
+                self.out.write('\n],\n"otherData": %s}\n' %
+                               json.dumps(self.summary()))
+            else:
+                self.out.write(json.dumps({"summary": self.summary()}) + "\n")
+            self.out.close()
+            self.out = None